@@ -0,0 +1,175 @@
+'''
+Benchmark Transcoder.transcode over the offline pages in fixtures/, run it from this directory:
+
+    python benchmark.py --rounds 20 --output result.json
+    python benchmark.py --baseline result.json
+
+Results are pages/sec, latency percentiles and per phase time per page, dumped as json so a run can be
+compared with a stored baseline.
+'''
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+import lxml.html as p
+
+from transcoder import Transcoder
+from utils import Utils
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+#fixture file, page url
+FIXTURES = [
+    ("article_small.html", "http://news.sina.com.cn/c/2012-10-30/091225471234.shtml"),
+    ("list_large.html", "http://news.example.com/list/index.shtml"),
+    ("forum_nested.html", "http://bbs.example.com/viewthread.php"),
+    ("table_layout.html", "http://www.example.com/news/"),
+    ("links_nested.html", "http://www.example.com/list/"),
+]
+
+class PhaseTimer(object):
+    '''
+    Wraps transcoder passes with timers, phases don't overlap.
+    '''
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+
+    def wrap(self, phase, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.totals[phase] += time.time() - start
+        timed.phase = phase
+        return timed
+
+    def install(self, transcoder):
+        transcoder._adjust_layout = self.wrap("layout_adjustment", transcoder._adjust_layout)
+        transcoder._extract_common_features = self.wrap("feature_extraction", transcoder._extract_common_features)
+        transcoder._postprocess_node = self.wrap("postprocess", transcoder._postprocess_node)
+
+        load_site = transcoder._load_site
+        def timed_load_site(host):
+            site = load_site(host)
+            classifiers = site[1]
+            for name, phase in (("valid_node_classifier", "validation"), ("list_page_classifier", "list_classification")):
+                if getattr(classifiers[name].classify, "phase", None) is None:
+                    classifiers[name].classify = self.wrap(phase, classifiers[name].classify)
+            return site
+        transcoder._load_site = timed_load_site
+
+        self._adjust_dom = Utils.__dict__["adjust_dom"]
+        Utils.adjust_dom = staticmethod(self.wrap("adjust_dom", Utils.adjust_dom))
+
+    def uninstall(self):
+        Utils.adjust_dom = self._adjust_dom
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[index]
+
+def load_fixture(filename):
+    with open(os.path.join(FIXTURE_DIR, filename), "rb") as f:
+        return f.read()
+
+def parse(html):
+    return p.document_fromstring(html, parser=p.HTMLParser(encoding="utf-8"))
+
+def run_fixture(transcoder, url, html, rounds):
+    #warm up
+    transcoder.transcode(url, parse(html))
+
+    latencies = []
+    for _ in range(rounds):
+        dom = parse(html)
+        start = time.time()
+        transcoder.transcode(url, dom)
+        latencies.append(time.time() - start)
+
+    return {
+        "rounds" : rounds,
+        "bytes" : len(html),
+        "pages_per_sec" : len(latencies) / sum(latencies),
+        "latency_ms" : {
+            "mean" : 1000 * sum(latencies) / len(latencies),
+            "p50" : 1000 * percentile(latencies, 50),
+            "p90" : 1000 * percentile(latencies, 90),
+            "p99" : 1000 * percentile(latencies, 99),
+            "max" : 1000 * max(latencies),
+        },
+    }
+
+def run_phases(url, html, rounds):
+    '''
+    Per phase time per page, measured on a separate transcoder since the timers add overhead.
+    '''
+    transcoder = Transcoder()
+    timer = PhaseTimer()
+    timer.install(transcoder)
+    try:
+        transcoder.transcode(url, parse(html))
+        timer.totals.clear()
+        for _ in range(rounds):
+            transcoder.transcode(url, parse(html))
+    finally:
+        timer.uninstall()
+
+    return dict((phase, 1000 * total / rounds) for phase, total in timer.totals.items())
+
+def run(rounds, fixtures=FIXTURES):
+    transcoder = Transcoder()
+    results = {}
+    for filename, url in fixtures:
+        html = load_fixture(filename)
+        result = run_fixture(transcoder, url, html, rounds)
+        result["phases_ms"] = run_phases(url, html, rounds)
+        results[os.path.splitext(filename)[0]] = result
+    return {"time" : time.time(), "python" : sys.version.split()[0], "pages" : results}
+
+def compare(result, baseline, threshold):
+    '''
+    Return names of pages whose p50 latency is more than threshold slower than baseline.
+    '''
+    regressions = []
+    for name, page in result["pages"].items():
+        if not baseline["pages"].has_key(name):
+            continue
+        old = baseline["pages"][name]["latency_ms"]["p50"]
+        new = page["latency_ms"]["p50"]
+        change = (new - old) / old if old > 0 else 0
+        print "%-16s p50 %8.2fms -> %8.2fms (%+.1f%%)" % (name, old, new, 100 * change)
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark Transcoder.transcode over offline pages")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--output", help="write results as json to this file")
+    parser.add_argument("--baseline", help="compare with results stored by a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed p50 slowdown against baseline")
+    args = parser.parse_args()
+
+    result = run(args.rounds)
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print output
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.threshold)
+        if len(regressions) > 0:
+            print "slower than baseline: %s" % ", ".join(regressions)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import os
+import tempfile
+import threading
+
+from utils import LRUCache
+
+#prefix of files being written, skipped when sizing and evicting the disk tier
+_temp_prefix = ".tmp"
+
+class OutputCache(object):
+    '''
+    Transcoded html keyed by content key (see Transcoder.transcode_html), kept in a memory LRU and,
+    if disk_dir is given, in files under disk_dir capped at disk_max_bytes. Once over the cap, least recently
+    used files are removed down to disk_low_water of it, so the directory isn't walked again on every put.
+    Disk errors only cost the disk tier, they're counted and never raised.
+    Safe to share between threads, the disk tier can be shared between processes.
+    '''
+    def __init__(self, memory_size=1024, disk_dir=None, disk_max_bytes=256 * 1024 * 1024, disk_low_water=0.8):
+        self._memory = LRUCache(memory_size)
+        self._disk_dir = disk_dir
+        self._disk_max_bytes = disk_max_bytes
+        self._disk_low_water_bytes = int(disk_max_bytes * disk_low_water)
+        self._lock = threading.Lock()
+        self._counts = {"hits" : 0, "misses" : 0, "memory_hits" : 0, "disk_hits" : 0, "disk_evictions" : 0, "disk_write_errors" : 0}
+        self._disk_bytes = 0
+        if disk_dir is not None:
+            if not os.path.isdir(disk_dir):
+                os.makedirs(disk_dir)
+            self._disk_bytes = sum(size for _, _, size in self._disk_files())
+
+    def _path(self, key):
+        return os.path.join(self._disk_dir, key[:2], key)
+
+    def _disk_files(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self._disk_dir):
+            for filename in filenames:
+                #in-flight writes of this or other processes
+                if filename.startswith(_temp_prefix):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError: #removed by another process
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _encode(self, value):
+        #bytes of value written to the disk tier, or None if it can't be stored there
+        return value
+
+    def _decode(self, data):
+        #value of bytes read from the disk tier, or None if they can't be read back
+        return data
+
+    def get(self, key):
+        value = self._memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            self._count("hits")
+            return value
+
+        if self._disk_dir is not None:
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    value = self._decode(f.read())
+                os.utime(path, None)
+            except (IOError, OSError):
+                value = None
+            if value is not None:
+                self._memory.put(key, value)
+                self._count("disk_hits")
+                self._count("hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    def put(self, key, value):
+        self._memory.put(key, value)
+        if self._disk_dir is None:
+            return
+        data = self._encode(value)
+        if data is None or len(data) > self._disk_max_bytes:
+            return
+
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError: #created by another thread or process
+                pass
+
+        #write to a temp file and rename, so readers never see partial files
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix=_temp_prefix, dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except (IOError, OSError): #disk full, or directory removed by clear or another process
+            self._count("disk_write_errors")
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return
+
+        with self._lock:
+            self._disk_bytes += len(data)
+            if self._disk_bytes > self._disk_max_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        files = sorted(self._disk_files())
+        self._disk_bytes = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self._disk_bytes <= self._disk_low_water_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+            self._counts["disk_evictions"] += 1
+
+    def clear(self):
+        self._memory.clear()
+        if self._disk_dir is not None:
+            with self._lock:
+                for _, path, _ in self._disk_files():
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self._disk_bytes = 0
+
+    def stats(self):
+        '''
+        Snapshot of counters: hits, misses, memory_hits, disk_hits, memory_evictions, disk_evictions,
+        disk_write_errors, memory_entries and disk_bytes.
+        '''
+        with self._lock:
+            stats = dict(self._counts)
+            stats["disk_bytes"] = self._disk_bytes
+        stats["memory_evictions"] = self._memory.evictions
+        stats["memory_entries"] = len(self._memory)
+        return stats
@@ -1,50 +1,43 @@
 import urlparse
 import os
+import time
 
 import lxml.html as p
 
-import classifier.svmutil as svmutil
+try:
+    import classifier.svmutil as svmutil
+except OSError: #libsvm.so not built, only linear svm models can be used
+    svmutil = None
 from utils import Utils
+from matchers import SubstringMatcher, PrefixWordMatcher, DomainMatcher
 import transcode.utils.misc as misc
 
 class FeatureExtractor(object):
-    def __init__(self, parameters, all_features):
+    def __init__(self, parameters):
         self._parameters = parameters
-        self._features = all_features
-        self._extra = {}
+        #name, word and domain lists are compiled once per config
+        self._name_matcher = SubstringMatcher(parameters["removed_names"])
+        self._word_matcher = PrefixWordMatcher(parameters["removed_words"])
+        self._domain_matcher = DomainMatcher(parameters["filtered_url_domains"])
 
-    def _is_not_filtered_by_name(self, node):
-        class_value = node.get("class", "")
-        id_value = node.get("id", "")
-        if class_value is not None and len(class_value) > 0 and len(filter(lambda item : class_value.find(item) != -1, self._parameters["removed_names"])) > 0:
+    def _is_not_filtered_by_name(self, node, context):
+        if self._name_matcher.match(node.get("class", "")):
             return False
 
-        if id_value is not None and len(id_value) > 0 and len(filter(lambda item : id_value.find(item) != -1, self._parameters["removed_names"])) > 0:
+        if self._name_matcher.match(node.get("id", "")):
             return False
 
         return True
 
-    def _is_not_filtered_by_word(self, node):
-        class_value = node.get("class", "")
-        id_value = node.get("id", "")
-        if self._contains_word(class_value):
+    def _is_not_filtered_by_word(self, node, context):
+        if self._word_matcher.match(node.get("class", "")):
             return False
-        if self._contains_word(id_value):
+        if self._word_matcher.match(node.get("id", "")):
             return False
 
         return True
 
-    def _contains_word(self, text):
-        if text is not None and len(text) > 0:
-            words = ''.join(map(lambda ch : ch if ch.isalpha() or ch.isdigit() else ' ', text))
-            words = words.split()
-            for word in words:
-                if len(filter(lambda w : w == word or w.startswith(word), self._parameters["removed_words"])) > 0:
-                    return True
-
-        return False
-
-    def _not_dynamic_node(self, node):
+    def _not_dynamic_node(self, node, context):
         tag_count = 0
         script_count = 0
         for child in node.getchildren():
@@ -55,17 +48,13 @@ class FeatureExtractor(object):
 
         return script_count == 0 or tag_count != script_count
 
-    def _link_not_empty(self, node):
+    def _link_not_empty(self, node, context):
         href = node.get('href', '')
         return href is not None and len(href) > 0
 
-    def _link_not_filtered(self, node):
+    def _link_not_filtered(self, node, context):
         #check if url domain is in filtered list
-        href = node.get('href', '')
-        parsed_result = urlparse.urlparse(href)
-        if len(parsed_result.netloc) > 0 and len(filter(lambda domain : parsed_result.netloc.find(domain) != -1, self._parameters["filtered_url_domains"])) > 0:
-            return False
-        return True
+        return not self._domain_matcher.match(node.get('href', ''))
 
     def _is_url_filename(self, url):
         parse_result = urlparse.urlparse(url)
@@ -79,103 +68,152 @@ class FeatureExtractor(object):
     #Notes: make sure the dependent features should be calculated before use
     _extractors = {
         #ValidNodeClassifier
-        "is_elem" : lambda self, node : isinstance(node, p.HtmlElement),
-        "in_whitelist":  lambda self, node : node.tag in self._parameters["white_tags"],
-        "not_in_blacklist": lambda self, node : not node.tag in self._parameters["black_tags"],
-        "not_hidden": lambda self, node : not Utils.is_hidden_node(node),
+        "is_elem" : lambda self, node, context : isinstance(node, p.HtmlElement),
+        "in_whitelist":  lambda self, node, context : node.tag in self._parameters["white_tags"],
+        "not_in_blacklist": lambda self, node, context : not node.tag in self._parameters["black_tags"],
+        "not_hidden": lambda self, node, context : not Utils.is_hidden_node(node, context.styles),
         "not_filtered_by_name": _is_not_filtered_by_name,
         "not_dynamic_node" : _not_dynamic_node,
         "not_filtered_by_word" : _is_not_filtered_by_word,
 
         #ReorderParentClassifier
-        "valid_reorder_parent_tag" : lambda self, node : node.tag in self._parameters["valid_reorder_parent_tags"],
-        "node_not_empty" : lambda self, node : len(node.getchildren()) > 0 or self._features[node]["text_length"] > 0,
-        "child_count_in_range" : lambda self, node :  len(node.getchildren()) > self._parameters["min_child_count"] and len(node.getchildren()) < self._parameters["max_child_count"],
+        "valid_reorder_parent_tag" : lambda self, node, context : node.tag in self._parameters["valid_reorder_parent_tags"],
+        "node_not_empty" : lambda self, node, context : len(node.getchildren()) > 0 or context.features.get(node, "text_length") > 0,
+        "child_count_in_range" : lambda self, node, context :  len(node.getchildren()) > self._parameters["min_child_count"] and len(node.getchildren()) < self._parameters["max_child_count"],
 
         #ReorderChildClassifier
-        "valid_reorder_child_tag" : lambda self, node : node.tag in self._parameters["valid_reorder_child_tags"],
-        "large_content" : lambda self, node : self._features[node]["text_length"] > self._parameters["min_text_length"] or self._features[node]["image_count"] > self._parameters["min_image_count"],
+        "valid_reorder_child_tag" : lambda self, node, context : node.tag in self._parameters["valid_reorder_child_tags"],
+        "large_content" : lambda self, node, context : context.features.get(node, "text_length") > self._parameters["min_text_length"] or context.features.get(node, "image_count") > self._parameters["min_image_count"],
 
         #ReorderRatingClassifier
-        "image_text_ratio" : lambda self, node : 1.0 * self._features[node]["image_count"] / self._features[node]["text_length"] if self._features[node]["text_length"] != 0 else 1, #TODO why 1 here
+        "image_text_ratio" : lambda self, node, context : 1.0 * context.features.get(node, "image_count") / context.features.get(node, "text_length") if context.features.get(node, "text_length") != 0 else 1, #TODO why 1 here
+
+        #Shared by LinkNodeClassifier and ListPageClassifier
+        "link_ratio" : lambda self, node, context : 1.0 * context.features.get(node, "link_length") / context.features.get(node, "text_length") if context.features.get(node, "text_length") != 0 else 0,
+        "non_link_length" : lambda self, node, context : context.features.get(node, "text_length") - context.features.get(node, "link_length"),
 
         #LinkNodeClassifier
-        "link_ratio_high" : lambda self, node : (1.0 * self._features[node]["link_length"] / self._features[node]["text_length"] if self._features[node]["text_length"] != 0 else 0) > self._parameters["link_ratio_threshold"],
-        "non_link_length_low" : lambda self, node : self._features[node]["text_length"] - self._features[node]["link_length"] < self._parameters["non_link_length_threshold"],
+        "link_ratio_high" : lambda self, node, context : self.extract_feature(node, "link_ratio", context) > self._parameters["link_ratio_threshold"],
+        "non_link_length_low" : lambda self, node, context : self.extract_feature(node, "non_link_length", context) < self._parameters["non_link_length_threshold"],
 
         #ListPageClassifier
-        "link_text_ratio" : lambda self, node : 1.0 * self._features[node]["link_length"] / self._features[node]["text_length"] if self._features[node]["text_length"] != 0 else 0,
-        "url_is_filename": lambda self, node : self._is_url_filename(self._extra["url"]),
-        "non_link_text_length_high" : lambda self, node: self._features[node]["text_length"] - self._features[node]["link_length"] >= self._parameters["non_link_text_threshold"],
-        "large_text_count_high" : lambda self, node : self._features[node]["large_text_count"] >= self._parameters["large_text_count_threshold"],
+        "link_text_ratio" : lambda self, node, context : self.extract_feature(node, "link_ratio", context),
+        "url_is_filename": lambda self, node, context : self._is_url_filename(context.extra["url"]),
+        "non_link_text_length_high" : lambda self, node, context : self.extract_feature(node, "non_link_length", context) >= self._parameters["non_link_text_threshold"],
+        "large_text_count_high" : lambda self, node, context : context.features.get(node, "large_text_count") >= self._parameters["large_text_count_threshold"],
 
         #ValidLinkClassifier
-        "link_not_nofollow" : lambda self, node : node.get("rel", "") != "nofollow",
+        "link_not_nofollow" : lambda self, node, context : node.get("rel", "") != "nofollow",
         "link_not_empty" : _link_not_empty,
         "link_not_filtered" : _link_not_filtered,
     }
 
 
-    def add_extra(self, key, value):
-        self._extra[key] = value
+    def extract_feature(self, node, feature_name, context):
+        '''
+        Extract a feature of node, each feature is computed at most once per node in a request.
+        '''
+        key = (node, feature_name)
+        if key in context.feature_memo:
+            context.feature_hits += 1
+            return context.feature_memo[key]
 
-    def extract_feature(self, node, feature_name):
         if FeatureExtractor._extractors.has_key(feature_name):
             extractor = FeatureExtractor._extractors[feature_name]
-            return extractor(self, node)
+            context.feature_misses += 1
+            if context.stats is not None:
+                #inclusive time, features built on other features include their time
+                start = time.time()
+                value = extractor(self, node, context)
+                context.stats.add_feature(feature_name, time.time() - start)
+            else:
+                value = extractor(self, node, context)
+            context.feature_memo[key] = value
+            return value
         else:
             raise Exception("feature %s not found" % feature_name)
 
-    def extract_features(self, node, feature_names):
+    def compile(self, feature_names):
+        '''
+        Check feature names and return them as a list, unknown features are reported at load time.
+        '''
+        for feature_name in feature_names:
+            if not FeatureExtractor._extractors.has_key(feature_name):
+                raise Exception("feature %s not found" % feature_name)
+        return list(feature_names)
+
+    def extract_features(self, node, feature_names, context):
         features = {}
         for feature_name in feature_names:
-            if self._features.has_key(feature_name):
-                features[feature_name] = self._features[feature_name]
-            else:
-                features[feature_name] = self.extract_feature(node, feature_name)
+            features[feature_name] = self.extract_feature(node, feature_name, context)
 
-        try:
-            node.set("features", str(node.get("features", "")) + " " + str(features))
-        except:
-            pass
         return features
 
 class ClassifierBase(object):
     @classmethod
-    def create_classifier(cls, classifier_name, feature_extraction_parameters, classifier_config, all_features):
+    def create_classifier(cls, classifier_name, feature_extraction_parameters, classifier_config, feature_extractor=None):
         classifier_type = classifier_config["type"]
         if classifier_type == "BooleanClassifier":
-            return BooleanClassifier(classifier_name, feature_extraction_parameters, classifier_config, all_features)
+            return BooleanClassifier(classifier_name, feature_extraction_parameters, classifier_config, feature_extractor)
         elif classifier_type == "LinearClassifier":
-            return LinearClassifier(classifier_name, feature_extraction_parameters, classifier_config, all_features)
+            return LinearClassifier(classifier_name, feature_extraction_parameters, classifier_config, feature_extractor)
         elif classifier_type == "SvmClassifier":
-            return SvmClassifier(classifier_name, feature_extraction_parameters, classifier_config, all_features)
+            return SvmClassifier(classifier_name, feature_extraction_parameters, classifier_config, feature_extractor)
         else:
             raise Exception("unsupported classifier_type %s" % type)
 
-    def __init__(self, name, parameters, config, all_features):
+    def __init__(self, name, parameters, config, feature_extractor=None):
         self._classifier_name = name
         self._parameters = parameters
         self._config = config
-        self._all_features = all_features
-        self._feature_extractor = FeatureExtractor(parameters, all_features)
+        self._feature_extractor = feature_extractor if feature_extractor is not None else FeatureExtractor(parameters)
         self._initialize()
 
     def _initialize(self):
         pass
 
-    def _extract_features(self, node):
-        return self._feature_extractor.extract_features(node, self._config["features"])
+    def _extract_features(self, node, context):
+        return self._feature_extractor.extract_features(node, self._config["features"], context)
 
     def _classify(self, features):
         pass
 
-    def add_extra(self, key, value):
-        self._feature_extractor.add_extra(key, value)
-
-    def classify(self, node):
-        features = self._extract_features(node)
-        return self._classify(features)
+    def classify(self, node, context):
+        decisions = context.decisions
+        if decisions is not None and self._classifier_name in decisions.classifier_names:
+            result = decisions.get(node, self._classifier_name)
+            if result is not None:
+                return result
+            result = self._timed_classify_node(node, context)
+            decisions.record(node, self._classifier_name, result)
+            return result
+
+        return self._timed_classify_node(node, context)
+
+    def _timed_classify_node(self, node, context):
+        if context.stats is None:
+            return self._classify_node(node, context)
+
+        start = time.time()
+        result = self._classify_node(node, context)
+        context.stats.add_classifier(self._classifier_name, time.time() - start, result)
+        return result
+
+    def _classify_node(self, node, context):
+        features = self._extract_features(node, context)
+        result = self._classify(features)
+        self._record(node, features, result, context)
+        return result
+
+    def _record(self, node, features, result, context):
+        if context.debug_attributes:
+            try:
+                node.set("features", str(node.get("features", "")) + " " + str(features))
+            except:
+                pass
+
+        if context.trace_sink is not None:
+            context.trace_sink.classifier_decision(context.url, node, self._classifier_name, features, result)
 
 class BooleanClassifier(ClassifierBase):
 
@@ -186,35 +224,27 @@ class BooleanClassifier(ClassifierBase):
     #op: eq, lt, gt, ne
     """
 
-    @classmethod
-    def _execute_model(cls, features, funcs, config, parameters):
-        """
-        funcs is a func dict, each func is name, bool func(features, parameters)
-        """
-        for name in config["features"]:
-            if features.has_key(name):
-                success = features[name] != 0
-            elif funcs is not None and funcs.has_key(name): #one switch can be optional
-                func = funcs[name]
-                success = func(features, parameters)
-            else:
-                raise Exception("unsupported name %s" % name)
-
-            if not success:
-                return False
-
-        return True
-
-    def _get_model(self):
-        pass
+    def _initialize(self):
+        #compiled once, features are extracted lazily and evaluation stops at the first false atom
+        self._predicates = self._feature_extractor.compile(self._config["features"])
 
-    def _classify(self, features):
-        model = self._get_model()
-        return BooleanClassifier._execute_model(features, model, self._config, self._parameters)
+    def _classify_node(self, node, context):
+        features = {}
+        success = True
+        for name in self._predicates:
+            features[name] = self._feature_extractor.extract_feature(node, name, context)
+            if features[name] == 0:
+                success = False
+                if context.stats is not None:
+                    context.stats.add_rejection(self._classifier_name, name)
+                break
+
+        self._record(node, features, success, context)
+        return success
 
 class LinearClassifier(ClassifierBase):
-    def _extract_features(self, node):
-        return self._feature_extractor.extract_features(node, self._config["linear"].keys())
+    def _extract_features(self, node, context):
+        return self._feature_extractor.extract_features(node, self._config["linear"].keys(), context)
 
     def _classify(self, features):
         score = 0
@@ -228,7 +258,58 @@ class LinearClassifier(ClassifierBase):
 
 class SvmClassifier(ClassifierBase):
     def _initialize(self):
-        self._svm_model = svmutil.svm_load_model(self._config["model_filepath"])
+        #linear models are predicted in python, libsvm is only needed for other kernels
+        self._linear_model = SvmClassifier._load_linear_model(self._config["model_filepath"])
+        if self._linear_model is None:
+            if svmutil is None:
+                raise Exception("libsvm is required for model %s" % self._config["model_filepath"])
+            self._svm_model = svmutil.svm_load_model(self._config["model_filepath"])
+
+    @classmethod
+    def _load_linear_model(cls, model_filepath):
+        '''
+        Collapse support vectors of a two-class linear model into (weights, rho, labels), weights are
+        indexed by feature index. Return None for other models.
+        '''
+        header = {}
+        with open(model_filepath) as f:
+            for line in f:
+                tokens = line.split()
+                if tokens == ["SV"]:
+                    break
+                if len(tokens) > 0:
+                    header[tokens[0]] = tokens[1:]
+
+            if header.get("kernel_type") != ["linear"] or header.get("nr_class") != ["2"] or not header.has_key("label"):
+                return None
+
+            weights = {}
+            for line in f:
+                tokens = line.split()
+                if len(tokens) == 0:
+                    continue
+                coef = float(tokens[0])
+                for token in tokens[1:]:
+                    index, value = token.split(":")
+                    weights[int(index)] = weights.get(int(index), 0.0) + coef * float(value)
+
+        weight_vector = [0.0] * (max(weights.keys() + [0]) + 1)
+        for index, weight in weights.items():
+            weight_vector[index] = weight
+        return weight_vector, float(header["rho"][0]), map(float, header["label"])
+
+    def _predict(self, feature_vector):
+        if self._linear_model is not None:
+            weights, rho, labels = self._linear_model
+            decision = -rho
+            for index, value in enumerate(feature_vector, 1):
+                if index < len(weights):
+                    decision += weights[index] * value
+            #same vote as libsvm for two classes
+            return labels[0] if decision > 0 else labels[1]
+
+        labels, _, _ = svmutil.svm_predict([0], [feature_vector], self._svm_model)
+        return labels[0]
 
     def _classify(self, features):
         self._normalize_features(features)
@@ -240,8 +321,7 @@ class SvmClassifier(ClassifierBase):
             else:
                 raise Exception("required feature not found %s" % feature_name)
 
-        labels, _, _ = svmutil.svm_predict([0], [feature_vector], self._svm_model)
-        return labels[0] == 1.0
+        return self._predict(feature_vector) == 1.0
 
     def _normalize_features(self, features):
         for name in features:
@@ -0,0 +1,119 @@
+import hashlib
+import json
+
+class FrozenConfig(object):
+    '''
+    Read only config mapping, nested dicts are frozen into FrozenConfig and lists into tuples.
+    fingerprint is a stable hash of the content, equal configs have equal fingerprints in every process.
+    '''
+    __slots__ = ("_items", "fingerprint")
+
+    def __init__(self, items):
+        self._items = dict((key, FrozenConfig._freeze(value)) for key, value in items.items())
+        self.fingerprint = hashlib.sha1(json.dumps(self.thaw(), sort_keys=True)).hexdigest()
+
+    @classmethod
+    def _freeze(cls, value):
+        if isinstance(value, FrozenConfig):
+            return value
+        if isinstance(value, dict):
+            return FrozenConfig(value)
+        if isinstance(value, (list, tuple)):
+            return tuple(FrozenConfig._freeze(item) for item in value)
+        return value
+
+    @classmethod
+    def _thaw(cls, value):
+        if isinstance(value, FrozenConfig):
+            return value.thaw()
+        if isinstance(value, tuple):
+            return [FrozenConfig._thaw(item) for item in value]
+        return value
+
+    def thaw(self):
+        '''
+        Plain nested dict and list copy of the config.
+        '''
+        return dict((key, FrozenConfig._thaw(value)) for key, value in self._items.items())
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
+    def has_key(self, key):
+        return key in self._items
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return self._items.keys()
+
+    def values(self):
+        return self._items.values()
+
+    def items(self):
+        return self._items.items()
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenConfig) and self.fingerprint == other.fingerprint
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def __reduce__(self):
+        return (FrozenConfig, (self.thaw(),))
+
+    def __repr__(self):
+        return "FrozenConfig(%r)" % self.thaw()
+
+def check_site_config(default_config, site_config, path=""):
+    '''
+    Return errors of a site config against the default config: keys the default config doesn't have
+    and dicts overriding plain values or the other way round.
+    '''
+    errors = []
+    for key, value in site_config.items():
+        key_path = path + "." + key if path else key
+        if not default_config.has_key(key):
+            errors.append("unknown key %s" % key_path)
+        elif isinstance(default_config[key], (dict, FrozenConfig)) != isinstance(value, (dict, FrozenConfig)):
+            errors.append("%s must %sbe a dict" % (key_path, "" if isinstance(default_config[key], (dict, FrozenConfig)) else "not "))
+        elif isinstance(value, (dict, FrozenConfig)):
+            errors.extend(check_site_config(default_config[key], value, key_path))
+    return errors
+
+def _merge_config(default_config, site_config):
+    items = dict(default_config.items())
+    for key, value in site_config.items():
+        if isinstance(items[key], (dict, FrozenConfig)):
+            items[key] = _merge_config(items[key], value)
+        else:
+            items[key] = value
+    return FrozenConfig(items)
+
+def load_config(default_config, site_config=None, name=None):
+    '''
+    Validate site_config against default_config and freeze the merged result, default_config is kept as is
+    and unchanged sections are shared with it. Raise an Exception listing all errors of site_config.
+    '''
+    if not isinstance(default_config, FrozenConfig):
+        default_config = FrozenConfig(default_config)
+    if site_config is None or len(site_config) == 0:
+        return default_config
+
+    errors = check_site_config(default_config, site_config)
+    if len(errors) > 0:
+        raise Exception("invalid config %s: %s" % (name, ", ".join(errors)))
+    return _merge_config(default_config, site_config)
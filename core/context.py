@@ -0,0 +1,38 @@
+from features import FeatureTable
+
+class TranscodeContext(object):
+    '''
+    Per request state of one transcode call. It is passed through the transcoder, classifiers and
+    feature extractors, so one Transcoder instance can serve several pages at the same time.
+    '''
+    def __init__(self, url, config, classifiers, styles, plan, debug_attributes=False, trace_sink=None):
+        self.url = url
+        self.config = config
+        self.classifiers = classifiers
+        #StyleProcessor of config
+        self.styles = styles
+        #ExecutionPlan compiled from config
+        self.plan = plan
+        #FeatureTable of visited nodes
+        self.features = FeatureTable()
+        self.head_node = None
+        self.extra = {"url" : url}
+        #write features into "data" and "features" attributes of nodes
+        self.debug_attributes = debug_attributes
+        #TraceSink receiving features and classifier decisions out of band, or None
+        self.trace_sink = trace_sink
+        #RequestStats if the transcoder is instrumented, or None
+        self.stats = None
+        #extracted features keyed by (node, feature name), see FeatureExtractor.extract_feature
+        self.feature_memo = {}
+        self.feature_hits = 0
+        self.feature_misses = 0
+        #number of <style> nodes moved to <head>
+        self.moved_styles = 0
+        #host's SubtreeCache entries, digests of the page's subtrees and key prefix if the transcoder is incremental
+        self.subtree_entries = None
+        self.subtree_digests = None
+        self.subtree_prefix = None
+        self.subtree_counts = {"hits" : 0, "misses" : 0, "stores" : 0, "reused_nodes" : 0}
+        #DecisionSession reusing stable classifier decisions of the host, or None
+        self.decisions = None
@@ -0,0 +1,150 @@
+import collections
+import threading
+
+from utils import LRUCache
+
+#classifiers whose decisions are reused by default, valid_node_classifier only reads the tag, class, id and
+#style of a node so its decisions follow from the signature. link_node_classifier and the reorder classifiers
+#also read text and link lengths, add them to trade exact output for fewer evaluations on template heavy hosts
+default_classifier_names = ("valid_node_classifier",)
+
+class DecisionCache(object):
+    '''
+    Classifier decisions per host keyed by the structural signature of a node, the tag, class, id and style path
+    from the root, so header, sidebar and footer templates shared by the pages of a host aren't classified
+    again on every page. A decision is reused once it was the same on min_observations pages in a row, a
+    signature whose decisions disagree, on one page or across pages, is always evaluated from then on.
+    At most max_entries decisions are kept per host, least recently updated evicted first, lookups don't take
+    locks or reorder entries since they are much more frequent than updates. Hit and miss counts live with
+    the host's decisions, so they're evicted together.
+    '''
+    #entry of a signature whose decisions disagreed
+    _unstable = (None, -1)
+
+    def __init__(self, classifier_names=default_classifier_names, max_hosts=64, max_entries=16384, min_observations=3):
+        self.classifier_names = frozenset(classifier_names)
+        self._hosts = LRUCache(max_hosts)
+        self._max_entries = max_entries
+        self.min_observations = min_observations
+        self._lock = threading.Lock()
+
+    def session(self, host, version=None):
+        '''
+        DecisionSession of one transcode call of host, version (e.g. the config fingerprint) separates
+        decisions made with different configs.
+        '''
+        with self._lock:
+            #(decisions, {"hits", "misses"}) of (host, version)
+            entry = self._hosts.get((host, version))
+            if entry is None:
+                entry = (collections.OrderedDict(), {"hits" : 0, "misses" : 0})
+                self._hosts.put((host, version), entry)
+        return DecisionSession(self, entry[0], entry[1])
+
+    def _update(self, entries, key, entry):
+        with self._lock:
+            entries.pop(key, None)
+            entries[key] = entry
+            while len(entries) > self._max_entries:
+                entries.popitem(last=False)
+
+    def _add_counts(self, counts, hits, misses):
+        with self._lock:
+            counts["hits"] += hits
+            counts["misses"] += misses
+
+    def stats(self, host=None):
+        '''
+        {host : {"hits", "misses", "hit_rate"}} of the hosts still cached, summed over their versions, or the
+        stats of one host.
+        '''
+        with self._lock:
+            stats = {}
+            for (name, _), (_, counts) in self._hosts.items():
+                totals = stats.setdefault(name, {"hits" : 0, "misses" : 0})
+                totals["hits"] += counts["hits"]
+                totals["misses"] += counts["misses"]
+        for totals in stats.values():
+            lookups = totals["hits"] + totals["misses"]
+            totals["hit_rate"] = float(totals["hits"]) / lookups if lookups > 0 else 0.0
+        if host is not None:
+            return stats.get(host)
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._hosts.clear()
+
+class DecisionSession(object):
+    '''
+    View of a DecisionCache for one transcode call, signatures are computed once per node and kept here.
+    '''
+    def __init__(self, cache, entries, counts):
+        self._cache = cache
+        self._entries = entries
+        self._counts = counts
+        self._signatures = {}
+        #keys already observed on this page: key : decision
+        self._observed = {}
+        self.classifier_names = cache.classifier_names
+        self.hits = 0
+        self.misses = 0
+
+    def signature(self, node):
+        signature = self._signatures.get(node)
+        if signature is not None:
+            return signature
+
+        parent = node.getparent()
+        if parent in self._signatures:
+            tag = node.tag if isinstance(node.tag, basestring) else "#"
+            signature = hash((self._signatures[parent], tag, node.get("class"), node.get("id"), node.get("style")))
+            self._signatures[node] = signature
+            return signature
+
+        #walk up to the closest ancestor with a known signature
+        chain = []
+        while node is not None and not node in self._signatures:
+            chain.append(node)
+            node = node.getparent()
+        signature = self._signatures[node] if node is not None else 0
+        for node in reversed(chain):
+            tag = node.tag if isinstance(node.tag, basestring) else "#"
+            signature = hash((signature, tag, node.get("class"), node.get("id"), node.get("style")))
+            self._signatures[node] = signature
+        return signature
+
+    def get(self, node, classifier_name):
+        '''
+        Stable decision of classifier_name for node's signature, or None. Decisions observed on this page
+        are evaluated again for the other nodes of the signature, so disagreements within a page are seen.
+        '''
+        key = (self.signature(node), classifier_name)
+        #plain dict lookup, OrderedDict.get doesn't reorder
+        entry = dict.get(self._entries, key)
+        if entry is not None and entry[1] >= self._cache.min_observations and not key in self._observed:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def record(self, node, classifier_name, result):
+        key = (self.signature(node), classifier_name)
+        #count one observation per page
+        if key in self._observed:
+            if self._observed[key] != result:
+                self._cache._update(self._entries, key, DecisionCache._unstable)
+            return
+        self._observed[key] = result
+
+        entry = dict.get(self._entries, key)
+        if entry is None:
+            self._cache._update(self._entries, key, (result, 1))
+        elif entry[1] >= 0:
+            if entry[0] == result:
+                self._cache._update(self._entries, key, (result, entry[1] + 1))
+            else:
+                self._cache._update(self._entries, key, DecisionCache._unstable)
+
+    def close(self):
+        self._cache._add_counts(self._counts, self.hits, self.misses)
@@ -0,0 +1,70 @@
+import array
+
+class FeatureTable(object):
+    '''
+    Per node features of one transcode call, stored column-wise. Each visited node gets a row in preorder,
+    each feature is an integer array indexed by row and parents holds the row of each node's parent, so a
+    finished subtree is summed into its parent with one add per column and whole columns can be handed to
+    batch classifiers or offline analysis. Arrays grow in blocks, only the first len(table) entries are rows.
+    Subtree sums are folded one row at a time as the walk unwinds rather than in one pass over parents
+    afterwards, the post-order passes (emptiness, link and reorder classifiers) of a node read its sums as
+    soon as its children are done. Classifiers get nodes, get and is_valid find their rows through a dict.
+    '''
+    names = ("text_length", "large_text_count", "image_count", "link_length", "link_length_bak", "link_count", "image_link_count", "short_link_count")
+
+    def __init__(self, capacity=256):
+        self._rows = {}
+        self._size = 0
+        #parent row of each row, -1 for the root
+        self.parents = array.array('l')
+        self.valid = array.array('b')
+        #feature name : array of values by row
+        self.columns = dict((name, array.array('l')) for name in FeatureTable.names)
+        self._column_list = [self.columns[name] for name in FeatureTable.names]
+        self._grow(capacity)
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self, count):
+        self.parents.extend(array.array('l', [-1]) * count)
+        self.valid.extend(array.array('b', [0]) * count)
+        for column in self._column_list:
+            column.extend(array.array('l', [0]) * count)
+
+    def add(self, node, parent=-1):
+        '''
+        Add a row of zero features for node, return its row.
+        '''
+        row = self._size
+        if row == len(self.parents):
+            self._grow(row)
+        self._size = row + 1
+        self._rows[node] = row
+        self.parents[row] = parent
+        return row
+
+    def row_of(self, node):
+        return self._rows[node]
+
+    def column(self, name):
+        return self.columns[name][:self._size]
+
+    def get(self, node, name):
+        return self.columns[name][self._rows[node]]
+
+    def is_valid(self, node):
+        return self.valid[self._rows[node]] == 1
+
+    def add_to_parent(self, row):
+        '''
+        Add features of row to its parent row, called once row's subtree is done.
+        '''
+        parent = self.parents[row]
+        for column in self._column_list:
+            column[parent] += column[row]
+
+    def to_dict(self, row):
+        features = dict((name, self.columns[name][row]) for name in FeatureTable.names)
+        features["valid"] = self.valid[row] == 1
+        return features
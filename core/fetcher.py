@@ -0,0 +1,233 @@
+'''
+Page fetching for the transcoder: keep-alive connections pooled per host, a limit of concurrent requests
+per host, and a memory and disk cache of response bodies revalidated with conditional GETs
+(If-None-Match / If-Modified-Since), so unchanged pages cost a 304 instead of a full download.
+'''
+import cPickle
+import hashlib
+import httplib
+import socket
+import threading
+import urlparse
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+from cache import OutputCache
+
+class FetchError(Exception):
+    pass
+
+class Response(object):
+    def __init__(self, url, status, headers, body, from_cache=False):
+        #final url after redirects
+        self.url = url
+        self.status = status
+        #lower case header name : value
+        self.headers = headers
+        self.body = body
+        #body was served from the cache, after a 304 or without revalidation
+        self.from_cache = from_cache
+
+class ResponseCache(OutputCache):
+    '''
+    Responses with an ETag or Last-Modified validator keyed by url, (headers, body) in a memory LRU and, if
+    disk_dir is given, pickled in files under disk_dir, with the disk cap, eviction and error handling of
+    OutputCache. Safe to share between threads, the disk tier between processes.
+    '''
+    def __init__(self, memory_size=256, disk_dir=None, disk_max_bytes=256 * 1024 * 1024, disk_low_water=0.8):
+        OutputCache.__init__(self, memory_size, disk_dir, disk_max_bytes, disk_low_water)
+
+    def _path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+        return OutputCache._path(self, hashlib.sha1(url).hexdigest())
+
+    def _encode(self, entry):
+        try:
+            return cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return None
+
+    def _decode(self, data):
+        try:
+            return cPickle.loads(data)
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+            return None
+
+    def put(self, url, headers, body):
+        OutputCache.put(self, url, (headers, body))
+
+class ConnectionPool(object):
+    '''
+    Idle keep-alive connections per (scheme, host, port) and a semaphore per host limiting concurrent requests,
+    at most max_per_host connections are open per host.
+    '''
+    def __init__(self, max_per_host=4, timeout=10):
+        self._max_per_host = max_per_host
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def slot(self, key):
+        with self._lock:
+            if not self._slots.has_key(key):
+                self._slots[key] = threading.BoundedSemaphore(self._max_per_host)
+            return self._slots[key]
+
+    def get(self, key):
+        '''
+        Return (connection, reused), an idle connection to key if there is one, otherwise a new one.
+        '''
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        connection_class = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        return connection_class(host, port, timeout=self._timeout), False
+
+    def put(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle.clear()
+
+class Fetcher(object):
+    '''
+    Fetches pages over pooled keep-alive connections, at most max_per_host requests to one host at a time.
+    Safe to share between threads, fetch_many runs fetches on max_workers threads.
+    '''
+    max_redirects = 5
+
+    def __init__(self, cache=None, max_per_host=4, max_workers=16, timeout=10, user_agent="transcoder"):
+        self.cache = cache
+        self._connections = ConnectionPool(max_per_host, timeout)
+        self._max_workers = max_workers
+        self._user_agent = user_agent
+        self._workers = None
+        self._workers_lock = threading.Lock()
+
+    @classmethod
+    def _key(cls, url):
+        #urlsplit and port raise ValueError on a bad ipv6 host or port
+        try:
+            parts = urlparse.urlsplit(url)
+            port = parts.port
+        except ValueError, e:
+            raise FetchError("bad url %s: %s" % (url, e))
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise FetchError("unsupported url %s" % url)
+        port = port or (443 if parts.scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        return (parts.scheme, parts.hostname, port), path
+
+    def _request(self, key, path, headers):
+        '''
+        Send one GET over a pooled connection, return (status, headers, body). A reused connection closed by
+        the server is retried once on a new connection.
+        '''
+        while True:
+            connection, reused = self._connections.get(key)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused:
+                    continue
+                raise FetchError("%s: %s" % (e.__class__.__name__, e))
+
+            response_headers = dict((name.lower(), value) for name, value in response.getheaders())
+            if response.will_close:
+                connection.close()
+            else:
+                self._connections.put(key, connection)
+
+            if response_headers.get("content-encoding") == "gzip":
+                try:
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                except zlib.error, e:
+                    raise FetchError("bad gzip body: %s" % e)
+                del response_headers["content-encoding"]
+            return response.status, response_headers, body
+
+    def fetch(self, url):
+        '''
+        GET url following redirects, return a Response. Raise FetchError if the page can't be fetched.
+        '''
+        for _ in range(Fetcher.max_redirects + 1):
+            key, path = Fetcher._key(url)
+            headers = {"User-Agent" : self._user_agent, "Accept-Encoding" : "gzip"}
+            cached = self.cache.get(url) if self.cache is not None else None
+            if cached is not None:
+                if cached[0].has_key("etag"):
+                    headers["If-None-Match"] = cached[0]["etag"]
+                if cached[0].has_key("last-modified"):
+                    headers["If-Modified-Since"] = cached[0]["last-modified"]
+
+            slot = self._connections.slot(key[1])
+            with slot:
+                status, response_headers, body = self._request(key, path, headers)
+
+            if status == 304 and cached is not None:
+                return Response(url, 200, cached[0], cached[1], True)
+            if status in (301, 302, 303, 307, 308) and response_headers.has_key("location"):
+                url = urlparse.urljoin(url, response_headers["location"])
+                continue
+
+            if self.cache is not None and status == 200 and "no-store" not in response_headers.get("cache-control", "") and \
+                    (response_headers.has_key("etag") or response_headers.has_key("last-modified")):
+                self.cache.put(url, response_headers, body)
+            return Response(url, status, response_headers, body)
+
+        raise FetchError("too many redirects %s" % url)
+
+    def __call__(self, url):
+        '''
+        (body, headers) of url if it's fetched with status 200, otherwise None, so a Fetcher can be used as the
+        fetcher of TranscodeService.
+        '''
+        #any failure is a page that can't be fetched, rather than an error of the service calling it
+        try:
+            response = self.fetch(url)
+        except Exception:
+            return None
+        return (response.body, response.headers) if response.status == 200 else None
+
+    def _fetch_result(self, url):
+        try:
+            return url, self.fetch(url), None
+        except FetchError, e:
+            return url, None, e
+
+    def fetch_many(self, urls):
+        '''
+        Fetch urls concurrently, return an iterator of (url, Response, error) in completion order,
+        Response is None if the page can't be fetched.
+        '''
+        with self._workers_lock:
+            if self._workers is None:
+                self._workers = ThreadPool(self._max_workers)
+        return self._workers.imap_unordered(self._fetch_result, urls)
+
+    def close(self):
+        with self._workers_lock:
+            if self._workers is not None:
+                self._workers.close()
+                self._workers.join()
+                self._workers = None
+        self._connections.close()
@@ -0,0 +1,78 @@
+import hashlib
+import threading
+
+from utils import LRUCache
+
+class SubtreeCache(object):
+    '''
+    Transcoded subtrees of earlier pages, per host. A subtree is keyed by a hash of its tags, attributes,
+    text and tails, so when the same block shows up again on a later page of the host its rewritten markup,
+    aggregated features and totals are reused instead of transcoding it again.
+    Only subtrees of min_nodes to max_nodes nodes are kept, so each node is copied into a bounded number of
+    entries, at most max_entries per host for max_hosts hosts.
+    '''
+    def __init__(self, max_hosts=64, max_entries=4096, min_nodes=8, max_nodes=1024):
+        self._hosts = LRUCache(max_hosts)
+        self._max_entries = max_entries
+        self.min_nodes = min_nodes
+        self.max_nodes = max_nodes
+        self._lock = threading.Lock()
+        self._counts = {"hits" : 0, "misses" : 0, "stores" : 0, "reused_nodes" : 0}
+
+    @classmethod
+    def _text(cls, value):
+        if value is None:
+            return ""
+        if isinstance(value, unicode):
+            return value.encode("utf-8")
+        return value
+
+    @classmethod
+    def digests(cls, root):
+        '''
+        {node : (digest, subtree node count)} of all nodes under root, computed bottom up in one pass.
+        A node's digest covers its subtree and the tails of its children, but not its own tail.
+        '''
+        digests = {}
+        nodes = list(root.iter())
+        #in reverse preorder every node comes after all of its descendants
+        for node in reversed(nodes):
+            h = hashlib.sha1()
+            h.update(node.tag if isinstance(node.tag, basestring) else "#" + node.tag.__name__)
+            for name, value in sorted(node.attrib.items()):
+                h.update("\0%s=%s" % (SubtreeCache._text(name), SubtreeCache._text(value)))
+            h.update("\0" + SubtreeCache._text(node.text))
+            size = 1
+            for child in node:
+                digest, child_size = digests[child]
+                h.update("\0" + digest + SubtreeCache._text(child.tail))
+                size += child_size
+            digests[node] = (h.digest(), size)
+        return digests
+
+    def entries(self, host):
+        '''
+        LRUCache of host's subtrees: key : (detached element, feature values, totals).
+        '''
+        with self._lock:
+            entries = self._hosts.get(host)
+            if entries is None:
+                entries = LRUCache(self._max_entries)
+                self._hosts.put(host, entries)
+            return entries
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counts[name] += value
+
+    def clear(self):
+        self._hosts.clear()
+
+    def stats(self):
+        '''
+        Snapshot of counters: hits, misses, stores, reused_nodes (nodes not transcoded thanks to hits) and hosts.
+        '''
+        with self._lock:
+            stats = dict(self._counts)
+        stats["hosts"] = len(self._hosts)
+        return stats
@@ -0,0 +1,75 @@
+import bisect
+import re
+import urlparse
+
+from utils import LRUCache
+
+#max number of distinct values whose match result is kept per matcher
+default_cache_size = 4096
+
+class SubstringMatcher(object):
+    '''
+    Checks if a value contains any of the items, compiled into one alternation regex. Results aren't memoized,
+    the regex search is cheaper than a cache lookup.
+    '''
+    def __init__(self, items):
+        if len(items) > 0:
+            self._regex = re.compile('|'.join(map(re.escape, items)))
+        else:
+            self._regex = None
+
+    def match(self, value):
+        if self._regex is None or value is None or len(value) == 0:
+            return False
+        return self._regex.search(value) is not None
+
+class PrefixWordMatcher(object):
+    '''
+    Splits a value into alphanumeric words and checks if any word is a prefix of one of the words,
+    by binary search in the sorted word list. Results are memoized in a plain dict emptied when it holds
+    cache_size values, lookups are on the per node hot path and don't take locks.
+    '''
+    _word_regex = re.compile(r'[^\W_]+', re.UNICODE)
+
+    def __init__(self, words, cache_size=default_cache_size):
+        self._words = sorted(words)
+        self._cache = {}
+        self._cache_size = cache_size
+
+    def _is_prefix(self, word):
+        index = bisect.bisect_left(self._words, word)
+        return index < len(self._words) and self._words[index].startswith(word)
+
+    def match(self, value):
+        if len(self._words) == 0 or value is None or len(value) == 0:
+            return False
+        result = self._cache.get(value)
+        if result is None:
+            result = any(self._is_prefix(word) for word in PrefixWordMatcher._word_regex.findall(value))
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[value] = result
+        return result
+
+class DomainMatcher(object):
+    '''
+    Checks if the host of an url is one of the domains or a subdomain of them.
+    '''
+    def __init__(self, domains, cache_size=default_cache_size):
+        self._domains = frozenset(domain.lower().strip('.') for domain in domains)
+        self._cache = LRUCache(cache_size)
+
+    def match_host(self, host):
+        if len(self._domains) == 0 or host is None or len(host) == 0:
+            return False
+        labels = host.lower().split('.')
+        return any('.'.join(labels[i:]) in self._domains for i in range(len(labels)))
+
+    def match(self, url):
+        if len(self._domains) == 0 or url is None or len(url) == 0:
+            return False
+        result = self._cache.get(url)
+        if result is None:
+            result = self.match_host(urlparse.urlparse(url).hostname)
+            self._cache.put(url, result)
+        return result
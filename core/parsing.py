@@ -0,0 +1,103 @@
+'''
+Parse front end for raw page bytes: the charset is sniffed once, from a byte order mark, the Content-Type
+header or a <meta> in the first sniff_bytes of the page, and handed to libxml2 so the page is decoded while
+it's parsed. Parsers are configured once per thread and encoding and reused for every page.
+'''
+import codecs
+import re
+import threading
+
+import lxml.html as p
+
+#bytes of the page searched for a <meta> charset
+sniff_bytes = 4096
+
+#encoding of undeclared pages which aren't valid utf-8, mostly gbk on the hosts this transcoder is written for
+fallback_encoding = "gb18030"
+
+#byte order mark : encoding, longest first
+_boms = ((codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_LE, "utf-16-le"), (codecs.BOM_UTF16_BE, "utf-16-be"))
+
+#declared encodings decoded as their superset, as browsers do
+_supersets = {"gb2312" : "gb18030", "gbk" : "gb18030", "ascii" : "cp1252", "iso8859-1" : "cp1252"}
+
+_header_charset = re.compile(r"charset\s*=\s*[\"']?\s*([^\"';\s]+)", re.I)
+_meta_charset = re.compile(r"<meta[^>]*?charset\s*=\s*[\"']?\s*([a-zA-Z0-9_.:-]+)", re.I)
+
+#per thread {encoding : parser}, lxml parsers can't be shared between threads
+_parsers = threading.local()
+
+def normalize_encoding(name):
+    '''
+    Python codec name of a declared charset, or None if it's unknown.
+    '''
+    try:
+        name = codecs.lookup(name.strip().lower()).name
+    except (LookupError, UnicodeError):
+        return None
+    return _supersets.get(name, name)
+
+def content_type(headers):
+    '''
+    Content-Type value of a header mapping with any case of names, or None.
+    '''
+    if headers is None:
+        return None
+    for name, value in headers.items():
+        if name.lower() == "content-type":
+            return value
+    return None
+
+def sniff_encoding(data, content_type=None):
+    '''
+    Return (encoding, byte order mark length) of raw page bytes. A byte order mark wins over the Content-Type
+    charset, which wins over a <meta> charset. Undeclared pages are utf-8 if they decode as utf-8, otherwise
+    fallback_encoding.
+    '''
+    for bom, encoding in _boms:
+        if data.startswith(bom):
+            return encoding, len(bom)
+
+    if content_type:
+        match = _header_charset.search(content_type)
+        encoding = normalize_encoding(match.group(1)) if match is not None else None
+        if encoding is not None:
+            return encoding, 0
+
+    match = _meta_charset.search(data, 0, sniff_bytes)
+    encoding = normalize_encoding(match.group(1)) if match is not None else None
+    if encoding is not None:
+        #a page read as ascii can't be utf-16, the declaration is wrong
+        return ("utf-8" if encoding.startswith("utf-16") else encoding), 0
+
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return fallback_encoding, 0
+    return "utf-8", 0
+
+def html_parser(encoding=None):
+    '''
+    This thread's lxml.html parser of encoding, created on first use. huge_tree lifts libxml2's depth limit,
+    without it deeply nested pages are silently cut off.
+    '''
+    parsers = getattr(_parsers, "parsers", None)
+    if parsers is None:
+        parsers = _parsers.parsers = {}
+    parser = parsers.get(encoding)
+    if parser is None:
+        parser = parsers[encoding] = p.HTMLParser(encoding=encoding, huge_tree=True)
+    return parser
+
+def parse_bytes(data, encoding, bom_length=0):
+    '''
+    Parse raw page bytes of a sniffed encoding into a document root, raise etree.ParserError or ValueError
+    if the page can't be parsed. Encodings libxml2 doesn't know are decoded in python first.
+    '''
+    if bom_length > 0:
+        data = data[bom_length:]
+    try:
+        parser = html_parser(encoding)
+    except LookupError:
+        return p.document_fromstring(data.decode(encoding, "replace"), parser=html_parser())
+    return p.document_fromstring(data, parser=parser)
@@ -0,0 +1,32 @@
+class ExecutionPlan(object):
+    '''
+    A resolved config compiled once per site: only the passes whose operation switches are on, tag lists as
+    frozensets and a per tag feature extraction table, so per node work skips what the config disables
+    without looking up nested config keys.
+    '''
+    def __init__(self, config, layout_passes, postprocess_passes, tag_handlers):
+        switches = config["operation_switches"]
+
+        #functions called as func(transcoder, node, context), in order
+        self.layout_passes = tuple(layout_passes)
+        self.postprocess_passes = tuple(postprocess_passes)
+        #tag : func(transcoder, node, row, context) writing node's features into row of context.features and
+        #returning whether node is valid, other tags get text features
+        self.tag_handlers = tag_handlers
+
+        self.filtered_tag_properties = dict((tag, frozenset(names)) for tag, names in config["filtered_tag_properties"].items())
+        self.changed_tag_properties = tuple(config["changed_tag_properties"].items())
+        self.link_containers = frozenset(config["link_containers"])
+
+        #emptiness check
+        self.check_empty = switches["hide_empty_nodes"] or switches["drop_empty_nodes"]
+        self.hide_empty = switches["hide_empty_nodes"]
+        self.default_empty_tags = frozenset(config["default_empty_tags"])
+        self.invisible_tags = frozenset(config["invisible_tags"])
+
+        self.drop_scripts_for_details = not switches["drop_scripts"] and switches["drop_scripts_for_details"]
+
+        self.large_text_threshold = config["large_text_threshold"]
+        self.min_link_length = config["min_link_length"]
+        self.link_threshold = config["link_threshold"]
+        self.short_link_threshold = config["short_link_threshold"]
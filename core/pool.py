@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import tempfile
+import time
+
+from transcoder import Transcoder
+
+#per process transcoder, built once by _init_worker
+_transcoder = None
+
+#mode of written outputs, what open() would give them, mkstemp creates files readable by the owner only
+_umask = os.umask(0)
+os.umask(_umask)
+_file_mode = 0666 & ~_umask
+
+def _init_worker():
+    global _transcoder
+    _transcoder = Transcoder()
+
+def _transcode_page(page):
+    #a page that fails is returned with None like an unparsable one, rather than aborting the whole stream
+    url, html = page
+    try:
+        return url, _transcoder.transcode_html(url, html)
+    except Exception:
+        return url, None
+
+def _transcode_request(page):
+    #errors are returned rather than raised, so completion callbacks always run
+    url, html, headers = page
+    try:
+        if headers is not None:
+            return _transcoder.transcode_bytes(url, html, headers), None
+        return _transcoder.transcode_html(url, html), None
+    except Exception, e:
+        return None, "%s: %s" % (e.__class__.__name__, e)
+
+def _write_file(path, data):
+    #write to a temp file and rename, so an output either exists complete or not at all
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError: #created by another worker
+            pass
+    fd, temp_path = tempfile.mkstemp(dir=directory or ".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(temp_path, _file_mode)
+    os.rename(temp_path, path)
+
+def _transcode_file(job):
+    output_path, url, input_path, html = job
+    start = time.time()
+    try:
+        if html is None:
+            with open(input_path, "rb") as f:
+                html = f.read()
+        result, error = _transcode_request((url, html, None))
+        if result is not None:
+            _write_file(output_path, result)
+        elif error is None:
+            error = "page can't be parsed"
+    except (IOError, OSError), e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    return output_path, url, error, time.time() - start
+
+class TranscoderPool(object):
+    '''
+    Pool of worker processes, each one keeps a warm Transcoder (configs, classifiers and svm model
+    are loaded once when the worker starts).
+    '''
+    def __init__(self, processes=None):
+        #worker count, multiprocessing.Pool starts one per cpu if processes is None
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(self.processes, _init_worker)
+
+    def transcode_many(self, pages, ordered=True, chunksize=1):
+        '''
+        Transcode an iterable of (url, html) pairs, return an iterator of (url, html) results.
+        Results come in input order if ordered, otherwise in completion order. Result html is None
+        if the page can't be parsed or transcoding it failed.
+        '''
+        if ordered:
+            return self._pool.imap(_transcode_page, pages, chunksize)
+        else:
+            return self._pool.imap_unordered(_transcode_page, pages, chunksize)
+
+    def transcode_files(self, jobs, chunksize=1):
+        '''
+        Transcode (output path, url, input path, html) jobs, html is read from input path by the worker if None
+        and the result is written to output path by the worker. Return an iterator of (output path, url, error,
+        seconds) in completion order, error is None on success.
+        '''
+        return self._pool.imap_unordered(_transcode_file, jobs, chunksize)
+
+    def worker_pids(self):
+        '''
+        Pids of the live workers, multiprocessing.Pool replaces a worker that dies and its page is lost.
+        '''
+        return [process.pid for process in self._pool._pool if process.exitcode is None]
+
+    def transcode_async(self, url, html, callback=None, headers=None):
+        '''
+        Queue one page, return an AsyncResult of (html, error), html is None if the page can't be parsed or
+        transcoding failed with error. callback is called with the same pair in a pool thread once it's done.
+        With headers (e.g. {"content-type" : ...}) html is raw bytes passed to Transcoder.transcode_bytes.
+        '''
+        return self._pool.apply_async(_transcode_request, ((url, html, headers),), callback=callback)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,302 @@
+'''
+Long running HTTP transcoding service, run it from this directory:
+
+    python server.py --port 8080 --processes 4 --max-queue 64 --max-fetches 64 --timeout 10
+
+    POST /transcode?url=<page url>    body is the page html, returns the transcoded html
+    GET  /transcode?url=<page url>    fetches the page with the service's fetcher (see fetcher.py) first
+    GET  /health                      200 while a queue slot is free, 503 otherwise
+    GET  /stats                       request counters and latency as json
+
+Pages are transcoded on a pool of warm worker processes. At most max_queue pages are queued or in work,
+more requests get 503 at once, and requests waiting longer than timeout seconds get 504. GET requests
+also take one of max_fetches fetch slots while their page is fetched, and get 503 at once if none is free.
+A pool with a dead worker, or a page in work for stuck_timeouts timeouts, is replaced by a new one.
+'''
+import argparse
+import itertools
+import json
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from multiprocessing import TimeoutError
+
+from fetcher import Fetcher, ResponseCache
+from parsing import content_type
+from pool import TranscoderPool
+
+#max request body size
+max_body_bytes = 16 * 1024 * 1024
+
+#a page in work longer than this many timeouts is taken as lost with a hung worker
+stuck_timeouts = 3
+
+class ServiceStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {"requests" : 0, "transcoded" : 0, "rejected" : 0, "timeouts" : 0, "failures" : 0, "fetch_failures" : 0, "recycled" : 0}
+        self._seconds = 0.0
+        self.started = time.time()
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def add_transcoded(self, seconds):
+        with self._lock:
+            self._counts["transcoded"] += 1
+            self._seconds += seconds
+
+    def get(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["mean_latency_ms"] = 1000 * self._seconds / self._counts["transcoded"] if self._counts["transcoded"] > 0 else 0.0
+        stats["uptime_seconds"] = time.time() - self.started
+        return stats
+
+class TranscodeService(object):
+    '''
+    Queues pages on a TranscoderPool with a bounded number of pages in the pool. A slot is only freed when
+    the worker is done with the page, so timed out pages still count against max_queue until they finish,
+    or when the pool is recycled because a worker died or a page has been in work for stuck_timeouts timeouts.
+    Fetches are bounded separately by max_fetches, so slow upstream hosts don't hold transcoding slots.
+    '''
+    def __init__(self, processes=None, max_queue=64, timeout=10, fetcher=None, max_fetches=64):
+        self._processes = processes
+        self._pool = TranscoderPool(processes)
+        self._pids = self._pool.worker_pids()
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._max_queue = max_queue
+        self._fetch_slots = threading.BoundedSemaphore(max_fetches)
+        self._max_fetches = max_fetches
+        self._fetching = 0
+        #ticket : start time of pages queued or in work
+        self._pending = {}
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+        self.timeout = timeout
+        #callable returning (body, headers) of a url or None, a Fetcher by default
+        self.fetcher = fetcher if fetcher is not None else Fetcher()
+        self.stats = ServiceStats()
+
+    def _release(self, ticket):
+        with self._lock:
+            #reclaimed when the pool was recycled
+            if not self._pending.has_key(ticket):
+                return
+            del self._pending[ticket]
+        self._slots.release()
+
+    def _check_pool(self):
+        '''
+        Replace the pool if one of its workers died, losing its page without a callback, or a page has been in
+        work for stuck_timeouts timeouts, and reclaim the slots of every page in it.
+        '''
+        with self._lock:
+            deadline = time.time() - stuck_timeouts * self.timeout
+            stuck = any(start < deadline for start in self._pending.itervalues())
+            if not stuck and self._pool.worker_pids() == self._pids:
+                return
+            old_pool = self._pool
+            self._pool = TranscoderPool(self._processes)
+            self._pids = self._pool.worker_pids()
+            reclaimed = len(self._pending)
+            self._pending.clear()
+        for _ in range(reclaimed):
+            self._slots.release()
+        self.stats.count("recycled")
+        #terminate waits for the workers, a hung one mustn't hold up the request
+        terminator = threading.Thread(target=old_pool.terminate)
+        terminator.daemon = True
+        terminator.start()
+
+    def health(self):
+        '''
+        Return (healthy, status), unhealthy while no slot is free even after a broken pool is replaced.
+        '''
+        self._check_pool()
+        with self._lock:
+            in_pool = len(self._pending)
+        healthy = in_pool < self._max_queue
+        return healthy, {"status" : "ok" if healthy else "unhealthy", "in_pool" : in_pool, "max_queue" : self._max_queue}
+
+    def fetch(self, url):
+        '''
+        Return (status, page body or error message, headers), headers only keep the page's Content-Type.
+        '''
+        if not self._fetch_slots.acquire(False):
+            self.stats.count("rejected")
+            return 503, "too many pages being fetched", None
+        with self._lock:
+            self._fetching += 1
+        try:
+            page = self.fetcher(url)
+        finally:
+            with self._lock:
+                self._fetching -= 1
+            self._fetch_slots.release()
+
+        if page is None:
+            self.stats.count("fetch_failures")
+            return 502, "page can't be fetched", None
+        html, headers = page
+        page_type = content_type(headers)
+        return 200, html, {"content-type" : page_type} if page_type else None
+
+    def transcode(self, url, html, headers=None):
+        '''
+        Return (status, html or error message), headers are used to find the charset of html.
+        '''
+        self._check_pool()
+        if not self._slots.acquire(False):
+            self.stats.count("rejected")
+            return 503, "too many pages queued"
+        start = time.time()
+        with self._lock:
+            ticket = next(self._tickets)
+            self._pending[ticket] = start
+            pool = self._pool
+
+        try:
+            pending = pool.transcode_async(url, html, lambda result: self._release(ticket), headers)
+        except:
+            self._release(ticket)
+            raise
+
+        try:
+            result, error = pending.get(self.timeout)
+        except TimeoutError:
+            self.stats.count("timeouts")
+            return 504, "transcoding timed out"
+
+        if result is None:
+            self.stats.count("failures")
+            return 422, error if error is not None else "page can't be parsed"
+
+        self.stats.add_transcoded(time.time() - start)
+        return 200, result
+
+    def get_stats(self):
+        stats = self.stats.get()
+        with self._lock:
+            stats["in_pool"] = len(self._pending)
+            stats["fetching"] = self._fetching
+        stats["max_queue"] = self._max_queue
+        stats["max_fetches"] = self._max_fetches
+        return stats
+
+    def close(self):
+        self._pool.close()
+
+    def terminate(self):
+        self._pool.terminate()
+
+class TranscodeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status, body, content_type="text/plain; charset=utf-8"):
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, value):
+        self._send(status, json.dumps(value, sort_keys=True), "application/json")
+
+    def _page_url(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        urls = query.get("url")
+        return urls[0] if urls else None
+
+    def _transcode(self, url, html, headers=None):
+        status, body = self.server.service.transcode(url, html, headers)
+        self._send(status, body, "text/html" if status == 200 else "text/plain; charset=utf-8")
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse.urlparse(self.path).path
+        if path == "/health":
+            healthy, status = service.health()
+            self._send_json(200 if healthy else 503, status)
+        elif path == "/stats":
+            self._send_json(200, service.get_stats())
+        elif path == "/transcode":
+            service.stats.count("requests")
+            url = self._page_url()
+            if url is None:
+                self._send(400, "url is required")
+                return
+            status, html, headers = service.fetch(url)
+            if status != 200:
+                self._send(status, html)
+                return
+            self._transcode(url, html, headers)
+        else:
+            self._send(404, "not found")
+
+    def do_POST(self):
+        service = self.server.service
+        if urlparse.urlparse(self.path).path != "/transcode":
+            self._send(404, "not found")
+            return
+
+        service.stats.count("requests")
+        url = self._page_url()
+        length = int(self.headers.get("Content-Length", 0))
+        if url is None:
+            self._send(400, "url is required")
+            return
+        if length <= 0 or length > max_body_bytes:
+            self._send(413 if length > 0 else 400, "html body is required, at most %d bytes" % max_body_bytes)
+            return
+        content_type = self.headers.get("Content-Type")
+        self._transcode(url, self.rfile.read(length), {"content-type" : content_type} if content_type else None)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class TranscodeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    One thread per connection, the threads only wait on the worker pool.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, TranscodeHandler)
+        self.service = service
+        self.verbose = verbose
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP transcoding service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, number of cpus by default")
+    parser.add_argument("--max-queue", type=int, default=64, help="pages queued or in work before requests get 503")
+    parser.add_argument("--max-fetches", type=int, default=64, help="pages fetched at a time before GET requests get 503")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds a request waits for its page")
+    parser.add_argument("--fetch-cache-dir", help="keep fetched pages under this directory")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    fetcher = Fetcher(ResponseCache(disk_dir=args.fetch_cache_dir), timeout=args.timeout)
+    service = TranscodeService(args.processes, args.max_queue, args.timeout, fetcher, args.max_fetches)
+    server = TranscodeServer((args.host, args.port), service, args.verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.terminate()
+        fetcher.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import copy
+import threading
+
+class RequestStats(object):
+    '''
+    Timers and counters of one transcode call, only touched by the thread running it.
+    '''
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        #classifier name : {"calls", "seconds", "true", "false", "rejected_by" : {feature name : n}}
+        self.classifiers = {}
+        #feature name : {"calls", "seconds"}
+        self.features = {}
+
+    def add_time(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def _classifier(self, name):
+        if not self.classifiers.has_key(name):
+            self.classifiers[name] = {"calls" : 0, "seconds" : 0.0, "true" : 0, "false" : 0, "rejected_by" : {}}
+        return self.classifiers[name]
+
+    def add_classifier(self, name, seconds, result):
+        stats = self._classifier(name)
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        if result:
+            stats["true"] += 1
+        else:
+            stats["false"] += 1
+
+    def add_rejection(self, name, feature_name):
+        rejected_by = self._classifier(name)["rejected_by"]
+        rejected_by[feature_name] = rejected_by.get(feature_name, 0) + 1
+
+    def add_feature(self, name, seconds):
+        if not self.features.has_key(name):
+            self.features[name] = {"calls" : 0, "seconds" : 0.0}
+        self.features[name]["calls"] += 1
+        self.features[name]["seconds"] += seconds
+
+class TranscodeStats(object):
+    '''
+    Totals of RequestStats aggregated per host, safe to share between threads and transcoders. The first
+    max_hosts hosts get their own totals, requests of later hosts are added to other_host, so a proxy serving
+    any host keeps bounded memory and label cardinality. Hosts aren't evicted, counters stay monotonic.
+    '''
+    other_host = "other"
+
+    def __init__(self, max_hosts=256):
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._max_hosts = max_hosts
+
+    @classmethod
+    def _merge(cls, dst, src):
+        for key, value in src.items():
+            if isinstance(value, dict):
+                TranscodeStats._merge(dst.setdefault(key, {}), value)
+            else:
+                dst[key] = dst.get(key, 0) + value
+
+    def add(self, host, request_stats):
+        with self._lock:
+            if not self._hosts.has_key(host) and len(self._hosts) >= self._max_hosts:
+                host = TranscodeStats.other_host
+            if not self._hosts.has_key(host):
+                self._hosts[host] = {"requests" : 0, "times" : {}, "counts" : {}, "classifiers" : {}, "features" : {}}
+            totals = self._hosts[host]
+            totals["requests"] += 1
+            TranscodeStats._merge(totals["times"], request_stats.times)
+            TranscodeStats._merge(totals["counts"], request_stats.counts)
+            TranscodeStats._merge(totals["classifiers"], request_stats.classifiers)
+            TranscodeStats._merge(totals["features"], request_stats.features)
+
+    def get(self, host=None):
+        '''
+        Snapshot of totals, {host : {"requests" : n, "times" : {phase : seconds}, "counts" : {name : n},
+        "classifiers" : {name : {...}}, "features" : {name : {...}}}}, or the totals of one host. Hosts past
+        max_hosts are under other_host.
+        '''
+        with self._lock:
+            if host is not None:
+                return copy.deepcopy(self._hosts.get(host))
+            return copy.deepcopy(self._hosts)
+
+    def classifier_summary(self):
+        '''
+        Classifier and feature totals over all hosts with per call time, most expensive first:
+        ([(classifier name, stats)], [(feature name, stats)]).
+        '''
+        classifiers = {}
+        features = {}
+        for totals in self.get().values():
+            TranscodeStats._merge(classifiers, totals["classifiers"])
+            TranscodeStats._merge(features, totals["features"])
+
+        for stats in classifiers.values() + features.values():
+            stats["per_call_seconds"] = stats["seconds"] / stats["calls"] if stats["calls"] > 0 else 0.0
+
+        by_time = lambda item : -item[1]["seconds"]
+        return sorted(classifiers.items(), key=by_time), sorted(features.items(), key=by_time)
+
+    def reset(self):
+        with self._lock:
+            self._hosts.clear()
+
+    @classmethod
+    def _escape(cls, value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def to_prometheus(self, prefix="transcoder"):
+        '''
+        Dump totals in prometheus text exposition format.
+        '''
+        hosts = self.get()
+        lines = []
+        lines.append("# HELP %s_requests_total Transcoded pages." % prefix)
+        lines.append("# TYPE %s_requests_total counter" % prefix)
+        for host, totals in sorted(hosts.items()):
+            lines.append('%s_requests_total{host="%s"} %d' % (prefix, TranscodeStats._escape(host), totals["requests"]))
+
+        lines.append("# HELP %s_phase_seconds_total Wall time spent in transcoder passes." % prefix)
+        lines.append("# TYPE %s_phase_seconds_total counter" % prefix)
+        for host, totals in sorted(hosts.items()):
+            for phase, seconds in sorted(totals["times"].items()):
+                lines.append('%s_phase_seconds_total{host="%s",phase="%s"} %f' % (prefix, TranscodeStats._escape(host), phase, seconds))
+
+        lines.append("# HELP %s_events_total Nodes visited, hidden, dropped and reordered, feature memo hits and misses." % prefix)
+        lines.append("# TYPE %s_events_total counter" % prefix)
+        for host, totals in sorted(hosts.items()):
+            for name, value in sorted(totals["counts"].items()):
+                lines.append('%s_events_total{host="%s",event="%s"} %d' % (prefix, TranscodeStats._escape(host), name, value))
+
+        lines.append("# HELP %s_classifier_seconds_total Wall time spent in classifiers." % prefix)
+        lines.append("# TYPE %s_classifier_seconds_total counter" % prefix)
+        for host, totals in sorted(hosts.items()):
+            for name, stats in sorted(totals["classifiers"].items()):
+                lines.append('%s_classifier_seconds_total{host="%s",classifier="%s"} %f' % (prefix, TranscodeStats._escape(host), name, stats["seconds"]))
+
+        lines.append("# HELP %s_classifier_decisions_total Classifier calls by decision." % prefix)
+        lines.append("# TYPE %s_classifier_decisions_total counter" % prefix)
+        for host, totals in sorted(hosts.items()):
+            for name, stats in sorted(totals["classifiers"].items()):
+                for decision in ("true", "false"):
+                    lines.append('%s_classifier_decisions_total{host="%s",classifier="%s",decision="%s"} %d' % (prefix, TranscodeStats._escape(host), name, decision, stats[decision]))
+
+        lines.append("# HELP %s_classifier_rejections_total Boolean classifier rejections by the feature which was false." % prefix)
+        lines.append("# TYPE %s_classifier_rejections_total counter" % prefix)
+        for host, totals in sorted(hosts.items()):
+            for name, stats in sorted(totals["classifiers"].items()):
+                for feature_name, value in sorted(stats["rejected_by"].items()):
+                    lines.append('%s_classifier_rejections_total{host="%s",classifier="%s",feature="%s"} %d' % (prefix, TranscodeStats._escape(host), name, feature_name, value))
+
+        lines.append("# HELP %s_feature_seconds_total Wall time spent extracting features, including features they use." % prefix)
+        lines.append("# TYPE %s_feature_seconds_total counter" % prefix)
+        for host, totals in sorted(hosts.items()):
+            for name, stats in sorted(totals["features"].items()):
+                lines.append('%s_feature_seconds_total{host="%s",feature="%s"} %f' % (prefix, TranscodeStats._escape(host), name, stats["seconds"]))
+
+        lines.append("# HELP %s_feature_extractions_total Features extracted, memo hits excluded." % prefix)
+        lines.append("# TYPE %s_feature_extractions_total counter" % prefix)
+        for host, totals in sorted(hosts.items()):
+            for name, stats in sorted(totals["features"].items()):
+                lines.append('%s_feature_extractions_total{host="%s",feature="%s"} %d' % (prefix, TranscodeStats._escape(host), name, stats["calls"]))
+
+        return "\n".join(lines) + "\n"
@@ -1,19 +1,202 @@
+'''
+Transcode one page or a batch of saved pages, run it from this directory:
+
+    python test.py <url> <output file>
+    python test.py <directory | tar archive> <output directory> [--processes N]
+    python test.py --manifest <manifest file> <output directory> [--processes N]
+
+A manifest has one page per line, "path" or "path url", paths relative to the manifest's directory.
+Pages in a directory or archive, and manifest pages without url, get their url from their relative path,
+either --base-url + path or "http://" + path when the first path component is the host.
+Each output is written to the page's relative path under the output directory, outputs newer than their
+input are skipped so an interrupted batch can be run again.
+'''
+import argparse
+import collections
+import os
 import sys
+import tarfile
+import threading
+import time
+import urlparse
+
 import lxml.html as p
 
 from transcoder import Transcoder
+from pool import TranscoderPool
+from fetcher import Fetcher, FetchError
 import transcode.utils.misc as misc
 
-url = sys.argv[1]
+def page_url(relative_path, base_url=None):
+    relative_path = relative_path.replace(os.sep, "/").lstrip("/")
+    if base_url is not None:
+        return base_url.rstrip("/") + "/" + relative_path
+    return "http://" + relative_path
+
+def is_inside(path, directory):
+    directory = os.path.abspath(directory)
+    return os.path.abspath(path).startswith(directory.rstrip(os.sep) + os.sep)
+
+def is_done(output_path, mtime):
+    try:
+        return os.path.getmtime(output_path) >= mtime
+    except OSError:
+        return False
+
+def directory_pages(directory):
+    '''
+    Yield (relative path, input path, html) of files under directory, html is None (read by workers).
+    '''
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            yield os.path.relpath(path, directory), path, None
+
+def manifest_pages(manifest):
+    '''
+    Yield (relative path, input path, html, url) of manifest lines, url is None if the line has none.
+    '''
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith("#"):
+                continue
+            path = os.path.join(base, fields[0])
+            yield os.path.normpath(fields[0]).lstrip("/"), path, None, fields[1] if len(fields) > 1 else None
+
+def tar_pages(archive):
+    '''
+    Yield (relative path, member mtime, html) of regular files in a tar archive, read one at a time.
+    '''
+    with tarfile.open(archive) as tar:
+        for member in tar:
+            if member.isfile():
+                yield os.path.normpath(member.name).lstrip("/"), member.mtime, tar.extractfile(member).read()
+            #drop the member list kept by TarFile, archives can have millions of members
+            tar.members = []
+
+def batch_jobs(args, summary):
+    '''
+    Yield (output path, url, input path, html) jobs, outputs newer than their inputs are counted as skipped.
+    Pages whose relative path leaves the output directory (e.g. "../x.html" in an archive) are counted as unsafe
+    and not transcoded.
+    '''
+    if args.manifest:
+        pages = ((relative_path, path, html, url, None) for relative_path, path, html, url in manifest_pages(args.input))
+    elif os.path.isdir(args.input):
+        pages = ((relative_path, path, html, None, None) for relative_path, path, html in directory_pages(args.input))
+    else:
+        pages = ((relative_path, None, html, None, mtime) for relative_path, mtime, html in tar_pages(args.input))
 
-dom = misc.load_dom(url)
+    for relative_path, path, html, url, mtime in pages:
+        output_path = os.path.join(args.output, relative_path)
+        if relative_path == os.curdir or relative_path.split(os.sep)[0] == os.pardir or not is_inside(output_path, args.output):
+            summary["unsafe"] += 1
+            continue
+        if mtime is None:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                mtime = None
+        if mtime is not None and is_done(output_path, mtime):
+            summary["skipped"] += 1
+            continue
+        yield output_path, url if url is not None else page_url(relative_path, args.base_url), path, html
 
-if dom is None:
-    print "dom tree can't be loaded"
-else:
+def bounded(jobs, window):
+    '''
+    Yield jobs with at most window of them not yet released, the pool's feeder thread reads its input
+    as fast as it can and would otherwise hold the whole archive in memory.
+    '''
+    slots = threading.Semaphore(window)
+    def generate():
+        for job in jobs:
+            slots.acquire()
+            yield job
+    return generate(), slots.release
+
+def run_batch(args):
+    summary = collections.Counter()
+    host_times = collections.defaultdict(lambda : [0, 0.0])
+    failures = []
+
+    pool = TranscoderPool(args.processes)
+    jobs, release = bounded(batch_jobs(args, summary), 4 * pool.processes * args.chunksize + 16)
+    start = time.time()
+    try:
+        for output_path, url, error, seconds in pool.transcode_files(jobs, args.chunksize):
+            release()
+            host = urlparse.urlparse(url).netloc
+            host_times[host][0] += 1
+            host_times[host][1] += seconds
+            if error is None:
+                summary["transcoded"] += 1
+            else:
+                summary["failed"] += 1
+                failures.append((url, error))
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    elapsed = time.time() - start
+
+    print "transcoded %d, failed %d, skipped %d in %.1fs, %.1f pages/sec" % (summary["transcoded"], summary["failed"], summary["skipped"], elapsed, (summary["transcoded"] + summary["failed"]) / elapsed if elapsed > 0 else 0.0)
+    if summary["unsafe"] > 0:
+        print "%d pages not transcoded, their paths lead outside the output directory" % summary["unsafe"]
+    for host, (count, seconds) in sorted(host_times.items(), key=lambda item : -item[1][1]):
+        print "  %-40s %8d pages %10.1fms/page" % (host, count, 1000 * seconds / count)
+    for url, error in failures[:args.max_failures]:
+        print "failed %s: %s" % (url, error)
+    if len(failures) > args.max_failures:
+        print "... %d more failures" % (len(failures) - args.max_failures)
+    return 1 if len(failures) > 0 or summary["unsafe"] > 0 else 0
+
+def run_single(url, output):
     transcoder = Transcoder()
-    result_dom = transcoder.transcode(url, dom)
-    new_html = p.tostring(result_dom)
-    with open(sys.argv[2], "w") as f:
+    if urlparse.urlparse(url).scheme in ("http", "https"):
+        fetcher = Fetcher()
+        try:
+            response = fetcher.fetch(url)
+        except FetchError, e:
+            print "page can't be fetched: %s" % e
+            return 1
+        finally:
+            fetcher.close()
+        new_html = transcoder.transcode_bytes(url, response.body, response.headers) if response.status == 200 else None
+        if new_html is None:
+            print "dom tree can't be loaded"
+            return 1
+    else:
+        dom = misc.load_dom(url)
+
+        if dom is None:
+            print "dom tree can't be loaded"
+            return 1
+
+        result_dom = transcoder.transcode(url, dom)
+        new_html = p.tostring(result_dom)
+    with open(output, "w") as f:
         f.write(new_html)
     print "finished"
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="transcode a page, or a directory, tar archive or manifest of saved pages")
+    parser.add_argument("input", help="page url, directory, tar archive or manifest")
+    parser.add_argument("output", help="output file for one page, output directory for a batch")
+    parser.add_argument("--manifest", action="store_true", help="input is a manifest of pages")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, number of cpus by default")
+    parser.add_argument("--chunksize", type=int, default=8, help="pages sent to a worker at a time")
+    parser.add_argument("--base-url", help="url prefix of relative page paths, http://<path> by default")
+    parser.add_argument("--max-failures", type=int, default=20, help="failures listed in the summary")
+    args = parser.parse_args()
+
+    if args.manifest or os.path.isdir(args.input) or (os.path.isfile(args.input) and tarfile.is_tarfile(args.input)):
+        return run_batch(args)
+    return run_single(args.input, args.output)
+
+if __name__ == "__main__":
+    sys.exit(main())
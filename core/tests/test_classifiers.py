@@ -0,0 +1,37 @@
+'''
+Run it from the core directory:
+
+    python -m unittest discover -s tests
+'''
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcoder_settings as settings
+from classifiers import SvmClassifier, svmutil
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "classifier")
+
+class SvmClassifierTest(unittest.TestCase):
+    @unittest.skipIf(svmutil is None, "libsvm.so is not built")
+    def test_linear_model_matches_svm_predict(self):
+        config = dict(settings.default_config["classifier_configs"]["list_page_classifier"])
+        config["model_filepath"] = os.path.join(MODEL_DIR, os.path.basename(config["model_filepath"]))
+        classifier = SvmClassifier("list_page_classifier", settings.default_config["feature_extraction_parameters"], config)
+        self.assertIsNotNone(classifier._linear_model)
+
+        #ratios and boolean features as extracted, plus vectors on the training points
+        rng = random.Random(0)
+        vectors = [[rng.random()] + [float(rng.randint(0, 1)) for _ in config["features"][1:]] for _ in range(3000)]
+        vectors += [[rng.uniform(-1, 2) for _ in config["features"]] for _ in range(1000)]
+        vectors += [[value / 10.0, a, b, c] for value in range(11) for a in (0.0, 1.0) for b in (0.0, 1.0) for c in (0.0, 1.0)]
+
+        model = svmutil.svm_load_model(config["model_filepath"])
+        expected, _, _ = svmutil.svm_predict([0] * len(vectors), vectors, model)
+        self.assertEqual([classifier._predict(vector) for vector in vectors], expected)
+
+if __name__ == "__main__":
+    unittest.main()
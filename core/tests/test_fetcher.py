@@ -0,0 +1,196 @@
+'''
+Run it from the core directory:
+
+    python -m unittest discover -s tests
+'''
+import BaseHTTPServer
+import gzip
+import os
+import shutil
+import SocketServer
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fetcher import Fetcher, FetchError, ResponseCache
+
+PAGE = "<html><body><p>page</p></body></html>"
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.not_modified = 0
+            self.active = 0
+            self.max_active = 0
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    /etag and /modified answer conditional GETs with 304, /gzip compresses the page, /redirect moves to /etag,
+    /slow takes a while and records how many requests run at once.
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body="", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_modified(self):
+        with self.server.lock:
+            self.server.not_modified += 1
+        self.send_response(304)
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                return self._not_modified()
+            return self._send(200, PAGE, [("ETag", '"v1"')])
+        if self.path == "/modified":
+            modified = "Mon, 01 Jan 2024 00:00:00 GMT"
+            if self.headers.get("If-Modified-Since") == modified:
+                return self._not_modified()
+            return self._send(200, PAGE, [("Last-Modified", modified)])
+        if self.path == "/gzip":
+            data = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=data, mode="wb") as f:
+                f.write(PAGE)
+            return self._send(200, data.getvalue(), [("Content-Encoding", "gzip")])
+        if self.path == "/redirect":
+            return self._send(302, "", [("Location", "/etag")])
+        if self.path.startswith("/slow"):
+            with self.server.lock:
+                self.server.active += 1
+                self.server.max_active = max(self.server.max_active, self.server.active)
+            time.sleep(0.1)
+            with self.server.lock:
+                self.server.active -= 1
+            return self._send(200, PAGE)
+        self._send(200, PAGE)
+
+class FetcherTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInServer()
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.base = "http://127.0.0.1:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.reset()
+        self.cache_dir = tempfile.mkdtemp()
+        self.fetcher = Fetcher(ResponseCache(disk_dir=self.cache_dir), max_per_host=2, max_workers=8)
+
+    def tearDown(self):
+        self.fetcher.close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_keep_alive_connection_is_reused(self):
+        for _ in range(3):
+            self.assertEqual(self.fetcher.fetch(self.base + "/page").body, PAGE)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_etag_revalidation(self):
+        first = self.fetcher.fetch(self.base + "/etag")
+        second = self.fetcher.fetch(self.base + "/etag")
+        self.assertFalse(first.from_cache)
+        self.assertTrue(second.from_cache)
+        self.assertEqual((second.status, second.body), (200, PAGE))
+        self.assertEqual(self.server.not_modified, 1)
+
+    def test_last_modified_revalidation_from_disk(self):
+        self.fetcher.fetch(self.base + "/modified")
+        #a new cache on the same directory only has the disk tier
+        self.fetcher.cache = ResponseCache(disk_dir=self.cache_dir)
+        response = self.fetcher.fetch(self.base + "/modified")
+        self.assertTrue(response.from_cache)
+        self.assertEqual(response.body, PAGE)
+        self.assertEqual(self.server.not_modified, 1)
+
+    def test_gzip_body_is_decompressed(self):
+        response = self.fetcher.fetch(self.base + "/gzip")
+        self.assertEqual(response.body, PAGE)
+        self.assertFalse(response.headers.has_key("content-encoding"))
+
+    def test_redirect_is_followed(self):
+        response = self.fetcher.fetch(self.base + "/redirect")
+        self.assertEqual(response.url, self.base + "/etag")
+        self.assertEqual((response.status, response.body), (200, PAGE))
+
+    def test_per_host_limit(self):
+        urls = [self.base + "/slow%d" % i for i in range(8)]
+        results = list(self.fetcher.fetch_many(urls))
+        self.assertEqual(sorted(url for url, _, _ in results), sorted(urls))
+        self.assertTrue(all(error is None for _, _, error in results))
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_bad_urls_raise_fetch_error(self):
+        for url in ("http://a.com:abc/", "http://[::1/", "ftp://a.com/"):
+            self.assertRaises(FetchError, self.fetcher.fetch, url)
+            self.assertIsNone(self.fetcher(url))
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _files(self):
+        return [name for _, _, names in os.walk(self.cache_dir) for name in names]
+
+    def test_disk_tier_is_capped(self):
+        cache = ResponseCache(memory_size=1, disk_dir=self.cache_dir, disk_max_bytes=10000, disk_low_water=0.5)
+        for i in range(20):
+            cache.put("http://a.com/%d" % i, {"etag" : str(i)}, "x" * 1000)
+        stats = cache.stats()
+        self.assertGreater(stats["disk_evictions"], 0)
+        self.assertLessEqual(stats["disk_bytes"], 10000)
+        self.assertEqual(cache.get("http://a.com/19"), ({"etag" : "19"}, "x" * 1000))
+
+    def test_write_error_is_counted(self):
+        cache = ResponseCache(disk_dir=self.cache_dir)
+        rename = os.rename
+        def fail(*args):
+            raise OSError("disk full")
+        os.rename = fail
+        try:
+            cache.put("http://a.com/", {"etag" : "1"}, PAGE)
+        finally:
+            os.rename = rename
+        self.assertEqual(cache.stats()["disk_write_errors"], 1)
+        self.assertEqual(self._files(), [])
+        self.assertEqual(cache.get("http://a.com/"), ({"etag" : "1"}, PAGE))
+
+if __name__ == "__main__":
+    unittest.main()
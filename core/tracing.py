@@ -0,0 +1,35 @@
+import json
+import threading
+
+class TraceSink(object):
+    '''
+    Receives per node features and classifier decisions of transcode calls, out of the output html.
+    '''
+    def node_features(self, url, node, features):
+        pass
+
+    def classifier_decision(self, url, node, classifier_name, features, result):
+        pass
+
+class JsonLinesTraceSink(TraceSink):
+    '''
+    Writes one json object per line, keyed by page url and node xpath.
+    '''
+    def __init__(self, output_file):
+        self._output_file = output_file
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _xpath(cls, node):
+        return node.getroottree().getpath(node)
+
+    def _write(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self._output_file.write(line + "\n")
+
+    def node_features(self, url, node, features):
+        self._write({"url" : url, "xpath" : JsonLinesTraceSink._xpath(node), "features" : features})
+
+    def classifier_decision(self, url, node, classifier_name, features, result):
+        self._write({"url" : url, "xpath" : JsonLinesTraceSink._xpath(node), "classifier" : classifier_name, "features" : features, "result" : result})
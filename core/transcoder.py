@@ -1,143 +1,542 @@
 import urlparse
 import copy
+import hashlib
+import os
+import threading
+import time
 
 import lxml.html as p
+import lxml.etree as etree
 
 import transcoder_settings as settings
-from utils import Utils
-from classifiers import ClassifierBase
+from utils import Utils, LRUCache, StyleProcessor
+from classifiers import ClassifierBase, FeatureExtractor
+from context import TranscodeContext
+from plan import ExecutionPlan
+from config import load_config
+from features import FeatureTable
+from incremental import SubtreeCache
+from parsing import sniff_encoding, content_type, html_parser, parse_bytes
+from stats import RequestStats
 from transcode.utils.misc import remove_space, label_count
 
+class LoadedSettings(object):
+    '''
+    Everything built from one version of the settings and model files, replaced as a whole by
+    Transcoder.reload_settings and never changed after, so a transcode call sees one consistent version.
+    '''
+    def __init__(self, sources, default_config, site_configs, default_site, site_cache, model_paths, models):
+        #(settings.default_config, settings.site_configs) the configs were loaded from
+        self.sources = sources
+        self.default_config = default_config
+        #host : FrozenConfig
+        self.site_configs = site_configs
+        #(config, classifiers, styles, plan, models fingerprint) of hosts without a site config
+        self.default_site = default_site
+        #LRUCache host : site tuple as default_site
+        self.site_cache = site_cache
+        #model files used by the configs and their (path, mtime, size) stamps
+        self.model_paths = model_paths
+        self.models = models
+        self.models_fingerprint = default_site[4]
+
 class Transcoder(object):
     @classmethod
-    def _init_classifiers(cls, config, all_features):
+    def _init_classifiers(cls, config):
         '''
         Init classifiers by settings.
         '''
         classifiers = {}
+        feature_extractor = FeatureExtractor(config["feature_extraction_parameters"])
         for name, classifier_config in config["classifier_configs"].items():
-            classifier = ClassifierBase.create_classifier(name, config["feature_extraction_parameters"], classifier_config, all_features)
+            classifier = ClassifierBase.create_classifier(name, config["feature_extraction_parameters"], classifier_config, feature_extractor)
             classifiers[name] = classifier
 
         return classifiers
 
     @classmethod
-    def _override_config(cls, default_config, site_config):
-        config = copy.deepcopy(default_config)
-        Transcoder._merge_config(config, site_config)
-        return config
+    def _init_styles(cls, config):
+        return StyleProcessor(config["filtered_css_properties"], config["changed_css_properties"])
 
     @classmethod
-    def _merge_config(cls, dst_config, src_config):
-        for key, value in src_config.items():
-            if dst_config.has_key(key): #ignore keys not existed in dst config
-                if isinstance(dst_config[key], dict) and isinstance(value, dict):
-                    Transcoder._merge_config(dst_config[key], value)
-                else:
-                    dst_config[key] = value
+    def _init_plan(cls, config):
+        '''
+        Compile config into an ExecutionPlan with the enabled passes and the per tag feature extraction table.
+        '''
+        switches = config["operation_switches"]
+        layout_passes = [func for switch, func in Transcoder._layout_passes if switches[switch]]
+        postprocess_passes = [func for switch, func in Transcoder._postprocess_passes if switches[switch]]
+
+        #skipped tags are only checked after the tags handled below
+        tag_handlers = dict((tag, Transcoder._skip_node) for tag in config["skipped_tags"])
+        tag_handlers["a"] = Transcoder._extract_anchor_features
+        tag_handlers["img"] = Transcoder._extract_image_features
+        tag_handlers["style"] = Transcoder._move_internal_style if switches["move_internal_styles"] else Transcoder._skip_node
+        if switches["drop_scripts"]:
+            tag_handlers["script"] = Transcoder._drop_script
+        else:
+            tag_handlers.pop("script", None)
+
+        return ExecutionPlan(config, layout_passes, postprocess_passes, tag_handlers)
+
+    @classmethod
+    def _model_paths(cls, configs):
+        '''
+        Sorted paths of model files used by configs.
+        '''
+        paths = set()
+        for config in configs:
+            for classifier_config in config["classifier_configs"].values():
+                if classifier_config.has_key("model_filepath"):
+                    paths.add(classifier_config["model_filepath"])
+        return sorted(paths)
+
+    @classmethod
+    def _model_stamps(cls, paths):
+        '''
+        (path, mtime, size) of model files, missing files are left out.
+        '''
+        stamps = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stamps.append((path, stat.st_mtime, stat.st_size))
+        return stamps
+
+    def __init__(self, site_cache_size=None, debug_attributes=None, trace_sink=None, stats=None, output_cache=None, subtree_cache=None, decision_cache=None, model_check_interval=None):
+        self._site_cache_size = site_cache_size if site_cache_size is not None else settings.site_cache_size
+        self._model_check_interval = model_check_interval if model_check_interval is not None else settings.model_check_interval
+        self._debug_attributes = debug_attributes if debug_attributes is not None else settings.debug_attributes
+        self._trace_sink = trace_sink
+        #TranscodeStats collecting per host timers and counters, instrumentation is off if None
+        self.stats = stats
+        #OutputCache used by transcode_html, or None
+        self.output_cache = output_cache
+        #SubtreeCache reusing unchanged subtrees of earlier pages of the same host, or None
+        self.subtree_cache = subtree_cache
+        #DecisionCache reusing classifier decisions stable across earlier pages of the same host, or None
+        self.decision_cache = decision_cache
+        #serializes reloads, a LoadedSettings is published by one assignment of self._loaded
+        self._reload_lock = threading.RLock()
+        self.reload_settings()
+
+    def reload_settings(self):
+        '''
+        Validate and freeze settings, rebuild default classifiers and drop cached per-site configs, call it after
+        settings are changed in place. Raise an Exception if a site config has unknown keys.
+        Everything is built before it's published, concurrent transcode calls keep using the previous version
+        until then.
+        '''
+        with self._reload_lock:
+            sources = (settings.default_config, settings.site_configs)
+            default_config = load_config(sources[0])
+            site_configs = {}
+            for host, site_config in sources[1].items():
+                site_configs[host] = load_config(default_config, site_config, host)
+            model_paths = Transcoder._model_paths([default_config] + site_configs.values())
+            models = Transcoder._model_stamps(model_paths)
+            default_site = (default_config, Transcoder._init_classifiers(default_config), Transcoder._init_styles(default_config),
+                    Transcoder._init_plan(default_config), hashlib.sha1(repr(models)).hexdigest())
+
+            self._loaded = LoadedSettings(sources, default_config, site_configs, default_site, LRUCache(self._site_cache_size), model_paths, models)
+            self._models_checked = time.time()
+
+    def _is_stale(self, loaded):
+        #settings module reloaded or replaced, or model files changed, model files are checked once per interval
+        if loaded.sources[0] is not settings.default_config or loaded.sources[1] is not settings.site_configs:
+            return True
+        now = time.time()
+        if now - self._models_checked < self._model_check_interval:
+            return False
+        self._models_checked = now
+        return Transcoder._model_stamps(loaded.model_paths) != loaded.models
 
-    def __init__(self):
-        self._all_features = {}
-        self._default_config = settings.default_config
-        self._default_classifiers = Transcoder._init_classifiers(self._default_config, self._all_features)
+    def _load_site(self, host):
+        '''
+        Get resolved config, classifiers, style processor, execution plan and model files fingerprint for host,
+        built once per host and kept in a bounded cache.
+        '''
+        loaded = self._loaded
+        if self._is_stale(loaded):
+            with self._reload_lock:
+                #another thread may have reloaded while this one waited
+                if self._loaded is loaded:
+                    self.reload_settings()
+                loaded = self._loaded
+
+        default_config = loaded.default_config
+        config = loaded.site_configs.get(host)
+        if config is None or config.fingerprint == default_config.fingerprint:
+            return loaded.default_site
+
+        site = loaded.site_cache.get(host)
+        if site is None:
+            if config["classifier_configs"].fingerprint != default_config["classifier_configs"].fingerprint or \
+                    config["feature_extraction_parameters"].fingerprint != default_config["feature_extraction_parameters"].fingerprint:
+                classifiers = Transcoder._init_classifiers(config)
+            else:
+                classifiers = loaded.default_site[1]
+            site = (config, classifiers, Transcoder._init_styles(config), Transcoder._init_plan(config), loaded.models_fingerprint)
+            loaded.site_cache.put(host, site)
+
+        return site
+
+    @classmethod
+    def transcode_many(cls, pages, processes=None, ordered=True, chunksize=1):
+        '''
+        Transcode (url, html) pairs on a pool of warm worker processes and yield (url, html) results,
+        in input order if ordered, otherwise in completion order.
+        '''
+        from pool import TranscoderPool
+
+        pool = TranscoderPool(processes)
+        try:
+            for result in pool.transcode_many(pages, ordered, chunksize):
+                yield result
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
 
     def transcode(self, url, dom):
         if dom is None:
             return None
 
-        #initialize
-        self._all_features.clear()
-
         #load per site config
         host = urlparse.urlparse(url).netloc
-        if settings.site_configs.has_key(host):
-            site_config = settings.site_configs[host]
-            config = Transcoder._override_config(self._default_config, site_config)
-            self._config = config
-            if site_config.has_key("classifier_configs") or site_config.has_key("feature_extraction_parameters"):
-                self._classifiers = Transcoder._init_classifiers(config, self._all_features)
-            else:
-                self._classifiers = self._default_classifiers
-        else:
-             self._config = self._default_config
-             self._classifiers = self._default_classifiers
+        config, classifiers, styles, plan, models_fingerprint = self._load_site(host)
+        context = TranscodeContext(url, config, classifiers, styles, plan, self._debug_attributes, self._trace_sink)
+        if self.stats is not None:
+            context.stats = RequestStats()
+            start = time.time()
 
         #extract head node
-        self._head_node = dom.find("head")
+        context.head_node = dom.find("head")
         # add head node?
-        if self._head_node is None:
-            self._head_node = p.Element("head")
-            dom.append(self._head_node)
+        if context.head_node is None:
+            context.head_node = p.Element("head")
+            dom.append(context.head_node)
+
+        if self.decision_cache is not None:
+            context.decisions = self.decision_cache.session(host, (config.fingerprint, models_fingerprint))
+
+        if self.subtree_cache is not None:
+            context.subtree_entries = self.subtree_cache.entries(host)
+            context.subtree_digests = SubtreeCache.digests(dom)
+            context.subtree_prefix = (config.fingerprint, models_fingerprint, self._debug_attributes)
 
         #recursively transcode
-        self._transcode(dom)
+        self._timed("transcode", context, self._transcode, dom, context)
+        if self.subtree_cache is not None:
+            for name, value in context.subtree_counts.items():
+                self.subtree_cache.count(name, value)
 
         #post-process
         Utils.add_default_headers(dom)
-        Utils.adjust_dom(dom)
+        self._timed("adjust_dom", context, Utils.adjust_dom, dom)
 
         #list page classification
-        self._classifiers["list_page_classifier"].add_extra("url", url)
-        is_list = self._classifiers["list_page_classifier"].classify(dom)
+        is_list = self._timed("list_classification", context, classifiers["list_page_classifier"].classify, dom, context)
 
         #special processes for details pages
         if not is_list:
-            self._process_details_page(dom)
+            self._timed("details_page", context, self._process_details_page, dom, context)
+
+        if context.decisions is not None:
+            context.decisions.close()
+
+        if self.stats is not None:
+            context.stats.add_time("total", time.time() - start)
+            context.stats.count("feature_memo_hits", context.feature_hits)
+            context.stats.count("feature_memo_misses", context.feature_misses)
+            self.stats.add(host, context.stats)
         return dom
 
-    def _process_details_page(self, root):
-        class_value = root.get('class','')
-        if class_value is not None and class_value.find('dlinks') > -1:
-            self._hide_node(root)
-            return
+    def transcode_html(self, url, html):
+        '''
+        Transcode an html string and return the result html, or None if it can't be parsed.
+        A byte string is transcoded by transcode_bytes, its charset sniffed from a byte order mark or <meta>.
+        With an output cache the result is keyed by the html, host, url path, resolved config and model files, so
+        a cached page is neither parsed nor transcoded again until settings or models change. The path is in the
+        key since the list page classifier reads whether the url names a file.
+        '''
+        if not isinstance(html, unicode):
+            return self.transcode_bytes(url, html)
+        return self._transcode_document(url, html.encode("utf-8"), "", lambda : p.document_fromstring(html, parser=html_parser()))
 
-        if not self._config["operation_switches"]["drop_scripts"] and self._config["operation_switches"]["drop_scripts_for_details"] and root.tag == "script":
-            root.drop_tree()
-            return
+    def transcode_bytes(self, url, raw_bytes, headers=None):
+        '''
+        Transcode raw page bytes, e.g. a response body and its headers, and return the result html, or None if
+        it can't be parsed. The charset is taken from a byte order mark, the Content-Type header or a <meta>
+        and the page is decoded by libxml2 while it's parsed (see parsing.py).
+        '''
+        encoding, bom_length = sniff_encoding(raw_bytes, content_type(headers))
+        return self._transcode_document(url, raw_bytes, encoding, lambda : parse_bytes(raw_bytes, encoding, bom_length))
+
+    def _transcode_document(self, url, data, encoding, parse):
+        key = None
+        if self.output_cache is not None:
+            parts = urlparse.urlparse(url)
+            site = self._load_site(parts.netloc)
+            config, models_fingerprint = site[0], site[4]
+            digest = hashlib.sha1(data).hexdigest()
+            #unicode urls are keyed by their utf-8 bytes, a mix of unicode and non-ascii bytes can't be joined
+            key_parts = (digest, encoding, parts.netloc, parts.path, config.fingerprint, models_fingerprint, str(self._debug_attributes))
+            key = hashlib.sha1("\0".join(part.encode("utf-8") if isinstance(part, unicode) else part for part in key_parts)).hexdigest()
+            result = self.output_cache.get(key)
+            if result is not None:
+                return result
+
+        try:
+            dom = parse()
+        except (etree.ParserError, ValueError):
+            return None
+
+        dom = self.transcode(url, dom)
+        if dom is None:
+            return None
+
+        result = p.tostring(dom)
+        if key is not None:
+            self.output_cache.put(key, result)
+        return result
+
+    def _timed(self, phase, context, func, *args):
+        if context.stats is None:
+            return func(*args)
+
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            context.stats.add_time(phase, time.time() - start)
 
-        for child in root.getchildren():
-            self._process_details_page(child)
+    def transcode_stream(self, url, input_file, output_file, encoding=None, chunk_size=64 * 1024):
+        '''
+        Feed html from input_file to an incremental parser in chunks and serialize the result straight
+        into output_file, so neither the input nor the output html is held as one string.
+        Return False if the page can't be parsed.
+        '''
+        parser = p.HTMLParser(encoding=encoding, huge_tree=True)
+        pending = None
+        while True:
+            chunk = input_file.read(chunk_size)
+            if not chunk:
+                break
+            if pending:
+                chunk = pending + chunk
+
+            #libxml2 push parser breaks end tags split over two chunks (e.g. "</scr" + "ipt>"), hold back an unclosed tag
+            index = chunk.rfind('<')
+            if index > -1 and chunk.find('>', index) == -1:
+                chunk, pending = chunk[:index], chunk[index:]
+            else:
+                pending = None
+
+            if chunk:
+                parser.feed(chunk)
+
+        if pending:
+            parser.feed(pending)
+
+        try:
+            dom = parser.close()
+        except etree.XMLSyntaxError:
+            return False
 
-    def _transcode(self, node):
-        #Validate node
-        if not self._classifiers["valid_node_classifier"].classify(node):
-            self._hide_node(node)
-            self._all_features[node] = {"valid" : False}
-            return False, None
+        dom = self.transcode(url, dom)
+        if dom is None:
+            return False
 
-        #Adjust layout to fit into mobile
-        self._adjust_layout(node)
+        with etree.htmlfile(output_file) as xf:
+            xf.write(dom)
+        return True
 
-        #Extract features
-        valid, features = self._extract_common_features(node)
+    def _process_details_page(self, root, context):
+        stack = [root]
+        while len(stack) > 0:
+            node = stack.pop()
+            class_value = node.get('class','')
+            if class_value is not None and class_value.find('dlinks') > -1:
+                self._hide_node(node, context)
+                continue
 
-        if not valid:
-            self._all_features[node] = {"valid" : False}
-            return False, None
+            if context.plan.drop_scripts_for_details and node.tag == "script":
+                self._drop_node(node, context)
+                continue
 
-        #recusive traverse children
-        for child in node.getchildren():
-            valid, child_features = self._transcode(child)
-            if valid:
-                features = Utils.aggregate_data(features, child_features)
+            #pushed reversed so children are visited in document order
+            stack.extend(reversed(node.getchildren()))
 
-        if (self._config["operation_switches"]["hide_empty_nodes"] or self._config["operation_switches"]["drop_empty_nodes"]) and Utils.is_empty_node(node, self._config["default_empty_tags"], self._config["invisible_tags"]):
-            self._all_features[node] = {"valid" : False}
-            if self._config["operation_switches"]["hide_empty_nodes"]:
-                self._hide_node(node)
+    def _transcode(self, root, context):
+        '''
+        Transcode root and its subtree, return (valid, row in context.features, totals), totals are the non-space text
+        length and image count of node's subtree, so emptiness and link checks don't need to walk the subtree again.
+        The subtree is walked in one loop on an explicit stack, so deep documents don't hit the recursion limit:
+        nodes are validated, adjusted and their features extracted on the way down, children are aggregated
+        and nodes post-processed on the way up. A stack frame is [node, row, totals, children, next child index,
+        subtree cache key, moved styles count].
+        '''
+        valid_node_classifier = context.classifiers["valid_node_classifier"]
+        adjust_layout = len(context.plan.layout_passes) > 0
+        stats = context.stats
+        table = context.features
+        stack = []
+        node = root
+        while True:
+            #pre-order: either push node's frame or get its result at once
+            result = None
+            parent = node.getparent()
+            key = None
+            entry = None
+            if context.subtree_entries is not None:
+                key = self._subtree_key(node, parent, context)
+                if key is not None:
+                    entry = context.subtree_entries.get(key)
+                    if entry is None:
+                        context.subtree_counts["misses"] += 1
+
+            if entry is not None:
+                node, result = self._reuse_subtree(node, parent, entry, stack[-1][1], context)
+            else:
+                row = table.add(node, stack[-1][1] if len(stack) > 0 else -1)
+                if stats is not None:
+                    stats.count("visited")
+
+                #Validate node
+                if not valid_node_classifier.classify(node, context):
+                    self._hide_node(node, context)
+                    result = (False, row, Utils.subtree_totals(node))
+                else:
+                    #Adjust layout to fit into mobile
+                    if not adjust_layout:
+                        pass
+                    elif stats is not None:
+                        start = time.time()
+                        self._adjust_layout(node, context)
+                        stats.add_time("adjust_layout", time.time() - start)
+                    else:
+                        self._adjust_layout(node, context)
+
+                    #Extract features
+                    valid = self._extract_common_features(node, row, context)
+
+                    if not valid:
+                        if node.getparent() is not parent: #dropped or moved away
+                            result = (False, row, [0, 0])
+                        else:
+                            result = (False, row, Utils.subtree_totals(node))
+                    else:
+                        stack.append([node, row, Utils.add_text_totals([0, 0], node.text), node.getchildren(), 0, key, context.moved_styles])
+
+            #post-order: fold finished nodes into their parents' frames until a child is left to enter
+            while True:
+                if result is not None:
+                    if len(stack) == 0:
+                        return result
+                    frame = stack[-1]
+                    valid, child_row, child_totals = result
+                    if valid:
+                        table.add_to_parent(child_row)
+                    totals = frame[2]
+                    totals[0] += child_totals[0]
+                    totals[1] += child_totals[1] + (1 if node.tag == "img" else 0)
+                    Utils.add_text_totals(totals, node.tail)
+
+                frame = stack[-1]
+                children = frame[3]
+                if frame[4] < len(children):
+                    node = children[frame[4]]
+                    frame[4] += 1
+                    break
+
+                stack.pop()
+                node = frame[0]
+                result = self._finish_node(node, frame[1], frame[2], context)
+                #subtrees which moved styles out to <head> can't be replayed from the cache
+                if frame[5] is not None and result[0] and frame[6] == context.moved_styles:
+                    self._store_subtree(node, frame[1], frame[2], frame[5], context)
+
+    def _subtree_key(self, node, parent, context):
+        '''
+        Subtree cache key of node, or None if node's subtree isn't cached: the root, <head> (context.head_node
+        must stay in the tree) and subtrees out of the cache's min_nodes to max_nodes range.
+        '''
+        if parent is None or node.tag == "head":
+            return None
+        digest = context.subtree_digests.get(node)
+        if digest is None or digest[1] < self.subtree_cache.min_nodes or digest[1] > self.subtree_cache.max_nodes:
+            return None
+        #node's own tail counts in its text_length if it has no text
+        return (context.subtree_prefix, digest[0], node.tail)
+
+    def _store_subtree(self, node, row, totals, key, context):
+        values = tuple(context.features.columns[name][row] for name in FeatureTable.names)
+        context.subtree_entries.put(key, (copy.deepcopy(node), values, tuple(totals)))
+        context.subtree_counts["stores"] += 1
+
+    def _reuse_subtree(self, node, parent, entry, parent_row, context):
+        '''
+        Replace node with a copy of its cached transcoded subtree, return (copy, result as of _transcode).
+        '''
+        element, values, totals = entry
+        clone = copy.deepcopy(element)
+        clone.tail = node.tail
+        parent.replace(node, clone)
+
+        table = context.features
+        row = table.add(clone, parent_row)
+        for name, value in zip(FeatureTable.names, values):
+            table.columns[name][row] = value
+        table.valid[row] = 1
+
+        context.subtree_counts["hits"] += 1
+        context.subtree_counts["reused_nodes"] += context.subtree_digests[node][1]
+        return clone, (True, row, list(totals))
+
+    def _finish_node(self, node, row, totals, context):
+        '''
+        Post-order part of _transcode, called after all children of node are transcoded and summed into row.
+        '''
+        plan = context.plan
+        if node.tag == "a":
+            context.features.columns["image_link_count"][row] += totals[1]
+
+        if plan.check_empty and Utils.is_empty_node(node, plan.default_empty_tags, plan.invisible_tags, totals[0]):
+            if plan.hide_empty:
+                self._hide_node(node, context)
             else:
                 if node.getparent() is not None:
                     print node.tag, p.tostring(node)
-                    node.drop_tree()
-            return False, None
+                    self._drop_node(node, context)
+            return False, row, totals
         else:
-            features["valid"] = True
-            self._all_features[node] = features
-            self._postprocess_node(node)
-            node.set("data", str(features))
-            return True, features
-
-    def _hide_node(self, node):
+            context.features.valid[row] = 1
+            if len(plan.postprocess_passes) == 0:
+                pass
+            elif context.stats is not None:
+                start = time.time()
+                self._postprocess_node(node, context)
+                context.stats.add_time("postprocess", time.time() - start)
+            else:
+                self._postprocess_node(node, context)
+            if context.debug_attributes:
+                node.set("data", str(context.features.to_dict(row)))
+            if context.trace_sink is not None:
+                context.trace_sink.node_features(context.url, node, context.features.to_dict(row))
+            return True, row, totals
+
+    def _drop_node(self, node, context):
+        node.drop_tree()
+        if context.stats is not None:
+            context.stats.count("dropped")
+
+    def _hide_node(self, node, context):
+        if context.stats is not None:
+            context.stats.count("hidden")
         if isinstance(node, p.HtmlElement):
             style = node.get("style", "")
             if style is not None and len(style) > 0:
@@ -146,116 +545,114 @@ class Transcoder(object):
                 style = "display: none !important;"
             node.set("style", style)
 
-    def _adjust_layout(self, node):
-        #filter invalid tag properties
-        if self._config["operation_switches"]["filter_tag_properties"]:
-            self._filter_tag_properties(node)
+    def _adjust_layout(self, node, context):
+        for layout_pass in context.plan.layout_passes:
+            layout_pass(self, node, context)
 
-        #change tag properties
-        if self._config["operation_switches"]["change_tag_properties"]:
-            self._change_tag_properties(node)
-
-        #change inline styles
-        if self._config["operation_switches"]["change_inline_styles"]:
-            self._change_inline_styles(node)
-
-    def _filter_tag_properties(self, node):
-        if self._config["filtered_tag_properties"].has_key(node.tag):
-            properties = self._config["filtered_tag_properties"][node.tag]
+    def _filter_tag_properties(self, node, context):
+        properties = context.plan.filtered_tag_properties.get(node.tag)
+        if properties is not None:
             for name in properties:
                 if name in node.attrib:
                     node.attrib.pop(name)
 
-    def _change_tag_properties(self, node):
-        for name, new_value in self._config["changed_tag_properties"].items():
+    def _change_tag_properties(self, node, context):
+        for name, new_value in context.plan.changed_tag_properties:
             old_value = node.get(name, None)
             if old_value is not None and len(old_value) > 0:
                 node.set(name, new_value)
 
 
-    def _change_inline_styles(self, node):
+    def _change_inline_styles(self, node, context):
         inline_style = node.get("style", "")
         if inline_style is not None and len(inline_style) > 0:
-            inline_style = Utils.shrink_style(inline_style, self._config["filtered_css_properties"], self._config["changed_css_properties"])
+            _, inline_style = context.styles.process(inline_style)
             if inline_style is not None:
                 node.set("style", inline_style)
             else:
                 node.attrib.pop("style")
 
-    def _extract_common_features(self, node):
-        features = {"link_length" : 0, "link_length_bak" : 0, "link_count" : 0, "image_link_count" : 0, "short_link_count" : 0, "text_length" : 0, "large_text_count" : 0, "image_count" : 0}
-        if node.tag == "a":
-            if self._classifiers["valid_link_classifier"].classify(node):
-                self._extract_link_features(node, features)
-            else:
-                self._hide_node(node)
-                return False, None
-        elif node.tag == "img":
-            features["image_count"] = 1
-            return True, features
-        elif node.tag == "style":
-            #move internal styles in <body> to <head>
-            if self._config["operation_switches"]["move_internal_styles"]:
-                self._move_internal_styles(node)
-            return False, None
-        elif node.tag == "script":
-            if self._config["operation_switches"]["drop_scripts"]:
-                node.drop_tree()
-                return False, None
-        elif node.tag in self._config["skipped_tags"]:
-            return False, None
-
-        features["text_length"] = label_count(remove_space(node.text.strip())) if node.text is not None else 0 + label_count(remove_space(node.tail.strip())) if node.tail is not None else 0
-
-        if features["text_length"] >= self._config["large_text_threshold"]:
-            features["large_text_count"] = 1
-
-        return True, features
-
-    def _move_internal_styles(self, node):
+    def _extract_common_features(self, node, row, context):
+        handler = context.plan.tag_handlers.get(node.tag)
+        if handler is not None:
+            return handler(self, node, row, context)
+        return self._extract_text_features(node, row, context)
+
+    def _extract_text_features(self, node, row, context):
+        text_length = label_count(remove_space(node.text.strip())) if node.text is not None else 0 + label_count(remove_space(node.tail.strip())) if node.tail is not None else 0
+        context.features.columns["text_length"][row] = text_length
+
+        if text_length >= context.plan.large_text_threshold:
+            context.features.columns["large_text_count"][row] = 1
+
+        return True
+
+    def _extract_anchor_features(self, node, row, context):
+        #link length is the label count of the link's whole text as found, the image count is added after children are traversed
+        if not context.classifiers["valid_link_classifier"].classify(node, context):
+            self._hide_node(node, context)
+            return False
+        self._extract_link_features(node, row, context)
+        return self._extract_text_features(node, row, context)
+
+    def _extract_image_features(self, node, row, context):
+        context.features.columns["image_count"][row] = 1
+        return True
+
+    def _move_internal_style(self, node, row, context):
+        #move internal styles in <body> to <head>
+        self._move_internal_styles(node, context.head_node)
+        context.moved_styles += 1
+        return False
+
+    def _drop_script(self, node, row, context):
+        self._drop_node(node, context)
+        return False
+
+    def _skip_node(self, node, row, context):
+        return False
+
+    def _move_internal_styles(self, node, head_node):
         parent_node = node.getparent()
         if not (parent_node is not None and parent_node.tag == "head"):
             node.drop_tree()
-            self._head_node.append(node)
-
-    def _extract_link_features(self, node, features):
-        text = node.text_content().strip()
-        text_length = Utils.label_count(text)
-        image_link_count = len(node.findall('.//img'))
-        features["link_length"] = text_length
-        features["image_link_count"] = image_link_count
-        features["short_link_count"] = 1 if text_length <= self._config["min_link_length"] else 0
-        features["link_count"] = 1
-        features["link_length_bak"] = text_length #TODO: not sure how is this used
+            head_node.append(node)
 
+    def _extract_link_features(self, node, row, context):
+        #labels are counted on the joined text, words split over child elements count once
+        if len(node) > 0:
+            text_length = Utils.label_count(node.text_content().strip())
+        else:
+            text_length = Utils.label_count(node.text.strip()) if node.text is not None else 0
+        columns = context.features.columns
+        columns["link_length"][row] = text_length
+        columns["short_link_count"][row] = 1 if text_length <= context.plan.min_link_length else 0
+        columns["link_count"][row] = 1
+        columns["link_length_bak"][row] = text_length #TODO: not sure how is this used
 
-    def _postprocess_node(self, node):
-        if self._config["operation_switches"]["reorder_nodes"]:
-            self._reorder_nodes(node)
 
-        if self._config["operation_switches"]["classify_nodes"]:
-            self._classify_nodes(node)
-        if self._config["operation_switches"]["mark_link_containers"] and node.tag in self._config["link_containers"]:
-            self._mark_link_containers(node)
+    def _postprocess_node(self, node, context):
+        for postprocess_pass in context.plan.postprocess_passes:
+            postprocess_pass(self, node, context)
 
-    def _classify_nodes(self, node):
+    def _classify_nodes(self, node, context):
         """
         classification result: link, navigation, spam
         """
 
-        is_link_node = self._classifiers["link_node_classifier"].classify(node)
+        is_link_node = context.classifiers["link_node_classifier"].classify(node, context)
         if is_link_node:
             Utils.add_class(node, 'dlinks')
 
-    def _reorder_nodes(self, node):
+    def _reorder_nodes(self, node, context):
        #valid reorder parent
-        if self._classifiers["reorder_parent_classifier"].classify(node):
+        if context.classifiers["reorder_parent_classifier"].classify(node, context):
             child_features = []
             for child in node.getchildren():
                 #valid reorder child
-                if self._all_features[child]["valid"] and self._classifiers["reorder_child_classifier"].classify(child):
+                if context.features.is_valid(child) and context.classifiers["reorder_child_classifier"].classify(child, context):
                     #calculate rating
-                    rating = self._classifiers["reorder_rating_classifier"].classify(child)
+                    rating = context.classifiers["reorder_rating_classifier"].classify(child, context)
                     child_features.append({"node" : child, "rating": rating})
                 else:
                     return False
@@ -265,6 +662,9 @@ class Transcoder(object):
                 child["node"].drop_tree() #can't hide
                 node.append(child["node"])
 
+            if context.stats is not None:
+                context.stats.count("reordered", len(child_features))
+
             return True
         else:
             return False
@@ -281,15 +681,21 @@ class Transcoder(object):
         for anchor in node.findall('.//a'):
             anchor.tail = None
 
-    def _mark_link_containers(self, node):
-        features = self._all_features[node]
-        if features["text_length"] > 0 and float(features['link_length'])/features["text_length"] > self._config["link_threshold"]:
-            if float(features['short_link_count']) / features['link_count'] > self._config["short_link_threshold"]:
+    def _mark_link_containers(self, node, context):
+        if node.tag not in context.plan.link_containers:
+            return
+
+        row = context.features.row_of(node)
+        columns = context.features.columns
+        text_length = columns["text_length"][row]
+        short_link_count = columns["short_link_count"][row]
+        if text_length > 0 and float(columns["link_length"][row])/text_length > context.plan.link_threshold:
+            if float(short_link_count) / columns["link_count"][row] > context.plan.short_link_threshold:
                 self._shrink_nav_node(node)
-                if features['short_link_count'] == 1:
+                if short_link_count == 1:
                     self._replace_child_class(node, 'dnav')
                     Utils.add_class(node, 'dnav')
-                elif features['short_link_count'] > 3:
+                elif short_link_count > 3:
                     self._replace_child_class(node, 'dnavb', new_class_name='dnavg')
                     Utils.add_class(node, 'dnavb')
                 else:
@@ -301,3 +707,17 @@ class Transcoder(object):
                 #features['link_count'] = 0
                 #features['short_link_count'] = 0
                 #features['link_length'] = 0
+
+    #operation switch, pass run on every valid node before its features are extracted, in order
+    _layout_passes = [
+        ("filter_tag_properties", _filter_tag_properties),
+        ("change_tag_properties", _change_tag_properties),
+        ("change_inline_styles", _change_inline_styles),
+    ]
+
+    #operation switch, pass run on every valid node after its subtree is transcoded, in order
+    _postprocess_passes = [
+        ("reorder_nodes", _reorder_nodes),
+        ("classify_nodes", _classify_nodes),
+        ("mark_link_containers", _mark_link_containers),
+    ]
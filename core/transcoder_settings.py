@@ -102,3 +102,12 @@ default_config = {
 site_configs = {
     "news.sina.com.cn" : {},
 }
+
+#max number of hosts whose resolved config and classifiers are cached by Transcoder
+site_cache_size = 64
+
+#write per node features into "data" and "features" attributes of the output html, for debugging only
+debug_attributes = False
+
+#seconds between checks of model files for changes, each check stats every model file
+model_check_interval = 5
@@ -1,20 +1,75 @@
+import collections
 import copy
 import re
+import threading
 
 import lxml.html as p
-import classifier.svmutil as svmutil
 
 from transcode.utils.misc import remove_space
 
+#max number of distinct inline style strings kept parsed by StyleProcessor
+style_cache_size = 4096
+
+#a label is a run of ascii letters and digits or any other non space character
+_label_pattern = re.compile(u"[0-9A-Za-z]+|\\S", re.U)
+
+class LRUCache(object):
+    ''' Bounded mapping which evicts the least recently used entry, safe to share between threads.
+    '''
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        #number of entries evicted to stay within capacity
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        if self._capacity <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._capacity:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def items(self):
+        ''' Snapshot of (key, value) pairs, least recently used first, without touching their order
+        '''
+        with self._lock:
+            return self._items.items()
+
+    def __len__(self):
+        return len(self._items)
+
 class Utils(object):
 
     _list_page_classifier = None
 
     @classmethod
-    def is_hidden_node(cls, node):
-        ''' Check if a node is hidden in html page
+    def is_hidden_node(cls, node, styles=None):
+        ''' Check if a node is hidden in html page, parsed styles are reused if a StyleProcessor is given
         '''
         style_list = node.get('style', None)
+        if styles is not None:
+            return styles.process(style_list)[0]
+        return cls.is_hidden_style(style_list)
+
+    @classmethod
+    def is_hidden_style(cls, style_list):
         if style_list:
             for p in style_list.split(';'):
                 tokens = p.split(':')
@@ -23,51 +78,43 @@ class Utils(object):
         return False
 
     @classmethod
-    def is_empty_node(cls, node, default_empty_tags, invisible_tags):
-        ''' Check if a node is empty
+    def is_empty_node(cls, node, default_empty_tags, invisible_tags, text_length=None):
+        ''' Check if a node is empty, text_length is the non-space text length of node's subtree if already known
         '''
         if node.tag not in default_empty_tags:
-            text_length = len(remove_space(node.text_content()))
+            if text_length is None:
+                text_length = len(remove_space(node.text_content()))
             #children_length = len(node.getchildren())
             children_length = len(filter(lambda child : child not in invisible_tags, node.getchildren()))
             return children_length == 0 and text_length == 0
         return False
 
+    @classmethod
+    def add_text_totals(cls, totals, text):
+        ''' Add non-space length of a text fragment to [text, image] totals
+        '''
+        if text:
+            totals[0] += len(remove_space(text))
+        return totals
+
+    @classmethod
+    def subtree_totals(cls, node):
+        ''' [non-space text length, image count] of node's subtree, node's own tail excluded
+        '''
+        totals = [0, 0]
+        if isinstance(node.tag, basestring):
+            for text in node.itertext():
+                cls.add_text_totals(totals, text)
+            totals[1] = len(node.findall('.//img'))
+        return totals
+
     @classmethod
     def label_count(cls, text):
         ''' calculate count of such labels: Chinese characters, English words, number and punctuations
         '''
         if not isinstance(text, unicode):
             return len(text)
-        else:
-            count = 0
-            fragments = text.split()
-            for fragment in fragments:
-                has_charactor_list = False
-                for uchar in fragment:
-                    if (uchar >= u'\u0030' and uchar<=u'\u0039') \
-                        or (uchar >= u'\u0041' and uchar<=u'\u005a') \
-                        or (uchar >= u'\u0061' and uchar<=u'\u007a'):
-                        has_charactor_list = True
-                    else:
-                        if has_charactor_list:
-                            count += 1
-                            has_charactor_list = False
-                        count += 1
-                if has_charactor_list:
-                    count += 1
-            return count
-
-    @classmethod
-    def aggregate_data(cls, data, sub_data):
-        if not (data and sub_data):
-            return data or sub_data
-        for key, value in sub_data.items():
-            if key in data:
-                data[key] += value
-            else:
-                data[key] = value
-        return data
+        return len(_label_pattern.findall(text))
 
     @classmethod
     def add_class(cls, node, classname):
@@ -108,16 +155,14 @@ class Utils(object):
             i += 1
 
     @classmethod
-    def shrink_style(cls, style_str, filtered_css_properties, changed_css_properties):
-        if not style_str:
-            return None
+    def parse_style(cls, style_str):
         properties = {}
         for p in style_str.split(';'):
             if p.strip():
                 token = p.split(':')
                 if len(token) > 1:
                     properties[token[0].strip()] = token[1].strip()
-        return Utils._shrink_properties(properties, filtered_css_properties, changed_css_properties)
+        return properties
 
     @classmethod
     def _shrink_properties(cls, properties, filtered_css_properties, changed_css_properties):
@@ -139,3 +184,31 @@ class Utils(object):
             return '{'+properties+'}'
         else:
             return None
+
+class StyleProcessor(object):
+    ''' Hidden check and rewrite of inline styles for one config. Each distinct style string is parsed once
+        per process and kept in a shared LRU, its rewrites are kept per config fingerprint.
+    '''
+    _cache = LRUCache(style_cache_size)
+
+    def __init__(self, filtered_css_properties, changed_css_properties):
+        self._filtered_css_properties = filtered_css_properties
+        self._changed_css_properties = changed_css_properties
+        self._fingerprint = (tuple(sorted(filtered_css_properties)), tuple(sorted(changed_css_properties.items())))
+
+    def process(self, style_str):
+        ''' Return (hidden, rewritten style), rewritten style is None if nothing is left
+        '''
+        if not style_str:
+            return False, None
+
+        entry = StyleProcessor._cache.get(style_str)
+        if entry is None:
+            #hidden flag, parsed properties, rewrites by config fingerprint
+            entry = (Utils.is_hidden_style(style_str), Utils.parse_style(style_str), {})
+            StyleProcessor._cache.put(style_str, entry)
+
+        hidden, properties, rewrites = entry
+        if not rewrites.has_key(self._fingerprint):
+            rewrites[self._fingerprint] = Utils._shrink_properties(properties, self._filtered_css_properties, self._changed_css_properties)
+        return hidden, rewrites[self._fingerprint]